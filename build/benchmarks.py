@@ -0,0 +1,318 @@
+#!/usr/bin/python3
+""" Benchmarks of discovery, render and store hot paths
+==================================================
+Synthetic Marathon tasks and SRV records are scaled to --tasks, app configs
+are scaled to --apps. Every synthetic service has 10 tasks on 2 named tcp
+ports, every app config uses 3 services. Results are written as JSON:
+    {"python": "3.5.2", "platform": "...", "time": 1500000000.0, "repeat": 3,
+     "results": [{"name": "DiscoveryMesos.resolve", "tasks": 100, "apps": 10,
+                  "backend": null, "changed": null, "ops": 10,
+                  "min": 0.001, "median": 0.001, "mean": 0.001}]}
+Times are seconds of all ops of one run. With --compare, min times are compared
+with previous results, exit code is 1 if any benchmark is slower than
+--threshold times.
+Run from surok directory: PYTHONPATH=. python3 build/benchmarks.py
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+import surok.apps
+import surok.config
+import surok.discovery
+import surok.store
+
+TASKS_PER_SERVICE = 10
+SERVICES_PER_APP = 3
+HOSTS = 100
+PORTS = ['web', 'admin']
+GROUP = 'bench'
+TEMPLATE = '''{% for name, hosts in my['services'].items() %}upstream {{ name }} {
+{% for host in hosts %}    server {{ host['ip'][0] }}:{{ host['tcp']['web'] }};
+{% endfor %}}
+{% endfor %}'''
+
+
+class SyntheticMesos(surok.discovery.DiscoveryMesos):
+    """ DiscoveryMesos with SRV and A records from memory """
+
+    def __init__(self, srv, a):
+        super().__init__()
+        self._srv = srv
+        self._a = a
+
+    def do_query_srv(self, fqdn):
+        return list(self._srv.get(fqdn, []))
+
+    def do_query_a(self, fqdn):
+        return list(self._a.get(fqdn, []))
+
+
+class SyntheticMarathon(surok.discovery.DiscoveryMarathon):
+    """ DiscoveryMarathon with tasks and A records from memory """
+
+    def __init__(self, tasks, ports, a):
+        super().__init__()
+        self._tasks = tasks
+        self._ports = ports
+        self._a = a
+
+    def do_query_a(self, fqdn):
+        return list(self._a.get(fqdn, []))
+
+
+# Synthetic Marathon tasks, app ports and mesos-dns records of tasks count
+def make_cluster(tasks_count, domain):
+    services = max(tasks_count // TASKS_PER_SERVICE, 1)
+    hosts = ['host{0}.{1}'.format(x, GROUP) for x in range(HOSTS)]
+    a = dict([(x, ['10.0.{0}.{1}'.format(i // 250, i % 250 + 1)]) for i, x in enumerate(hosts)])
+    tasks = []
+    ports = {}
+    srv = {}
+    for s in range(services):
+        name = 'svc{}'.format(s)
+        app_id = '/{0}/{1}'.format(GROUP, name)
+        service_ports = [10000 + s * len(PORTS) + i for i in range(len(PORTS))]
+        ports[app_id] = [{'name': port, 'protocol': 'tcp', 'servicePort': service_ports[i]}
+                         for i, port in enumerate(PORTS)]
+        for t in range(TASKS_PER_SERVICE):
+            host = hosts[(s * TASKS_PER_SERVICE + t) % HOSTS]
+            task_ports = [31000 + (s * TASKS_PER_SERVICE + t) % 1000 * len(PORTS) + i
+                          for i in range(len(PORTS))]
+            tasks.append({'id': '{0}.{1}'.format(name, t), 'appId': app_id, 'host': host,
+                          'ports': task_ports, 'servicePorts': service_ports})
+            for i, port in enumerate(PORTS):
+                for fqdn in ['_{0}._{1}.{2}._tcp.{3}'.format(port, name, GROUP, domain),
+                             '_{0}.{1}._tcp.{2}'.format(name, GROUP, domain)]:
+                    srv.setdefault(fqdn, []).append({'name': host, 'port': str(task_ports[i])})
+    return {'services': services, 'tasks': tasks, 'ports': ports, 'srv': srv, 'a': a}
+
+
+# App configs of apps count, every app uses SERVICES_PER_APP services
+def make_apps(apps_count, services):
+    apps = []
+    for i in range(apps_count):
+        app_services = []
+        for j in range(SERVICES_PER_APP):
+            service = {'name': 'svc{}'.format((i + j) % services)}
+            if j == 0:
+                service['tcp'] = []
+            else:
+                service['tcp'] = ['web']
+            app_services.append(service)
+        apps.append(surok.config.AppConfig({'conf_name': 'app{}'.format(i),
+                                            'services': app_services,
+                                            'group': GROUP}))
+    return apps
+
+
+# Run func repeat times
+# Return dict with min, median and mean duration
+def measure(func, repeat):
+    durations = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(i)
+        durations.append(time.perf_counter() - start)
+    return {'min': min(durations),
+            'median': statistics.median(durations),
+            'mean': statistics.mean(durations)}
+
+
+def result(name, timing, ops, tasks=None, apps=None, backend=None, changed=None):
+    res = {'name': name, 'tasks': tasks, 'apps': apps, 'backend': backend,
+           'changed': changed, 'ops': ops}
+    res.update(timing)
+    print('{name:<28} tasks={tasks!s:<6} apps={apps!s:<5} backend={backend!s:<9} '
+          'changed={changed!s:<5} median={median:.6f}s'.format(**res), file=sys.stderr)
+    return res
+
+
+def bench_discovery(config, tasks_counts, apps_counts, repeat):
+    results = []
+    compatible = surok.discovery.Discovery().compatible
+    for tasks_count in tasks_counts:
+        cluster = make_cluster(tasks_count, config['mesos']['domain'])
+        mesos = SyntheticMesos(cluster['srv'], cluster['a'])
+        marathon = SyntheticMarathon(cluster['tasks'], cluster['ports'], cluster['a'])
+        for apps_count in apps_counts:
+            apps = make_apps(apps_count, cluster['services'])
+            for name, discovery in [('DiscoveryMesos.resolve', mesos),
+                                    ('DiscoveryMarathon.resolve', marathon)]:
+                timing = measure(lambda i: [discovery.resolve(x) for x in apps], repeat)
+                results.append(result(name, timing, len(apps), tasks_count, apps_count))
+            # Version 0.8 returns hosts as is, version 0.7 converts them
+            hosts = [mesos.resolve(x) for x in apps]
+            version = config.get('version')
+            config['version'] = '0.7'
+            try:
+                timing = measure(lambda i: [compatible(x) for x in hosts], repeat)
+            finally:
+                config['version'] = version
+            results.append(result('Discovery.compatible', timing, len(hosts), tasks_count, apps_count))
+    return results
+
+
+def bench_render(config, apps_counts, repeat):
+    results = []
+    modules = surok.apps.LoadModules()
+    cluster = make_cluster(max(apps_counts) * TASKS_PER_SERVICE, config['mesos']['domain'])
+    mesos = SyntheticMesos(cluster['srv'], cluster['a'])
+    for apps_count in apps_counts:
+        contexts = []
+        for app in make_apps(apps_count, cluster['services']):
+            my = {'services': mesos.resolve(app), 'conf_name': app['conf_name'],
+                  'env': {}, 'timestamp': time.time()}
+            contexts.append(modules.context(my, {}))
+
+        def render(i):
+            for context in contexts:
+                surok.apps._render(context, TEMPLATE)
+        # Template is compiled once and cached
+        render(None)
+        timing = measure(render, repeat)
+        results.append(result('Apps._render', timing, len(contexts), apps=apps_count))
+    return results
+
+
+# Memcached is benchmarked only if its server is reachable
+def memcached_available(host):
+    try:
+        import memcache
+        address = host.split(':')
+        socket.create_connection((address[0], int(address[1]) if len(address) > 1 else 11211), 1).close()
+        return True
+    except:
+        return False
+
+
+def bench_store(config, apps_counts, repeat, memcached_host, workdir):
+    results = []
+    files_path = os.path.join(workdir, 'files')
+    os.mkdir(files_path)
+    backends = ['memory', 'files', 'sqlite']
+    settings = {'files': {'enabled': True, 'path': files_path},
+                'sqlite': {'enabled': True, 'path': os.path.join(workdir, 'surok.sqlite')}}
+    if memcached_available(memcached_host):
+        backends.append('memcached')
+        settings['memcached'] = {'enabled': True, 'host': memcached_host,
+                                 'namespace': 'surok-bench-{}'.format(uuid.uuid4().hex),
+                                 'discovery': {'enabled': False}}
+    else:
+        print('Memcached {} is not available, skip it'.format(memcached_host), file=sys.stderr)
+    config.set_config(settings)
+    store = surok.store.Store()
+    store.check()
+    try:
+        for backend in backends:
+            for apps_count in apps_counts:
+                prefix = os.path.join(workdir, backend, str(apps_count))
+
+                # Every app has one file and one environment
+                def records(i):
+                    return [r for x in range(apps_count) for r in [
+                        {'dest': '{0}/app{1}.conf'.format(prefix, x),
+                         'value': 'config {0} {1}'.format(x, i), 'store': backend},
+                        {'env': 'BENCH_{0}_{1}_{2}'.format(backend.upper(), apps_count, x),
+                         'value': 'env {0} {1}'.format(x, i), 'store': backend}]]
+
+                def check_update(temps):
+                    for temp in temps:
+                        store.check_update(temp)
+                changed = [records(i) for i in range(repeat)]
+                timing = measure(lambda i: check_update(changed[i]), repeat)
+                results.append(result('Store.check_update', timing, len(changed[0]),
+                                      apps=apps_count, backend=backend, changed=True))
+                unchanged = changed[-1]
+                timing = measure(lambda i: check_update(unchanged), repeat)
+                results.append(result('Store.check_update', timing, len(unchanged),
+                                      apps=apps_count, backend=backend, changed=False))
+    finally:
+        # Records and manifest of run namespace are removed from memcached
+        if 'memcached' in backends:
+            memcached = store._stores['memcached']
+            memcached._mc.delete_multi(memcached.keys() + [memcached._manifest_key()])
+    store._update_store.clear()
+    return results
+
+
+def result_key(res):
+    return tuple(res.get(x) for x in ('name', 'tasks', 'apps', 'backend', 'changed'))
+
+
+# Compare min times with previous results
+# Return list of regressions
+def compare(results, old_results, threshold):
+    old = dict([(result_key(x), x) for x in old_results])
+    regressions = []
+    for res in results:
+        prev = old.get(result_key(res))
+        if prev is None or not prev['min']:
+            continue
+        ratio = res['min'] / prev['min']
+        if ratio > threshold:
+            regressions.append(res)
+        print('{0:<28} tasks={1!s:<6} apps={2!s:<5} backend={3!s:<9} changed={4!s:<5} '
+              '{5:.6f}s -> {6:.6f}s x{7:.2f}{8}'.format(
+                  *(result_key(res) + (prev['min'], res['min'], ratio,
+                                       ' REGRESSION' if ratio > threshold else ''))), file=sys.stderr)
+    return regressions
+
+
+def int_list(value):
+    return [int(x) for x in value.split(',') if x]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of discovery, render and store hot paths')
+    parser.add_argument('-o', '--output', default='benchmarks.json', help='results JSON path, "-" for stdout')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs of every benchmark')
+    parser.add_argument('--tasks', type=int_list, default=[100, 1000, 10000], help='tasks counts')
+    parser.add_argument('--apps', type=int_list, default=[10, 100, 1000], help='app configs counts')
+    parser.add_argument('--memcached', default='localhost:11211', help='memcached host for store benchmark')
+    parser.add_argument('--compare', help='previous results JSON path')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='slowdown ratio of min time reported as regression')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='surok-bench-')
+    try:
+        confd = os.path.join(workdir, 'conf.d')
+        modules = os.path.join(workdir, 'modules')
+        os.mkdir(confd)
+        os.mkdir(modules)
+        config = surok.config.Config({'confd': confd, 'modules': modules, 'loglevel': 'error',
+                                      'mesos': {'enabled': True, 'domain': 'marathon.mesos'},
+                                      'marathon': {'enabled': True}})
+        results = bench_discovery(config, args.tasks, args.apps, args.repeat)
+        results += bench_render(config, args.apps, args.repeat)
+        results += bench_store(config, args.apps, args.repeat, args.memcached, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    data = {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.time(),
+            'repeat': args.repeat,
+            'results': results}
+    if args.output == '-':
+        json.dump(data, sys.stdout, indent=2, sort_keys=True)
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            old_results = json.load(f)['results']
+        if compare(results, old_results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,540 @@
+#!/usr/bin/python3
+""" Local Marathon and mesos-dns simulator for end-to-end load testing
+==================================================
+Marathon - HTTP server of /v2/apps (with ?embed=apps.tasks), /v2/tasks and
+    POST /v2/apps/<id>/restart
+mesos-dns - authoritative UDP DNS server of records
+    _<port>._<name>.<group>._tcp.<domain> SRV, _<name>.<group>._tcp.<domain> SRV
+    and A records of agents
+Scenarios change cluster at --rate changes per second:
+    scale-up - add task to app
+    scale-down - remove task of app
+    failover - agent fails, its tasks are moved to other agents
+    mixed - all changes in turn
+Driver runs surok.py with app config per simulated app, file template with
+endpoints of app tasks and reload_cmd, and measures time from every change
+to rewritten file and to completed reload_cmd. Results are written as JSON:
+    {"scenario": "failover", "discovery": "marathon_api", "rate": 1.0, "changes": 10,
+     "file": {"count": 10, "min": 0.5, "p50": 1.0, "p95": 1.5, "max": 2.0, "mean": 1.0},
+     "reload": {...}, "superseded": 0, "timeouts": 0}
+Run from surok directory: python3 build/simulator.py --scenario failover --discovery mesos_dns
+Simulator only, without driver: python3 build/simulator.py --serve
+"""
+import argparse
+import http.server
+import itertools
+import json
+import os
+import random
+import shutil
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+
+GROUP = 'sim'
+PORTS = ['http', 'admin']
+SCENARIOS = ['scale-up', 'scale-down', 'failover', 'mixed']
+TEMPLATE = ('{% for name, hosts in my["services"].items() %}{% for host in hosts|sort(attribute="name") %}'
+            '{{ name }} {{ host["name"] }}:{{ host["tcp"]["http"] }}\n'
+            '{% endfor %}{% endfor %}')
+
+
+class Cluster:
+    """ Simulated Marathon apps and tasks on agents
+    ==================================================
+    Every app has at most one task per agent, every task has own ports.
+    .add_app(name, instances) - add app with tasks
+    .scale(name, delta) - add or remove tasks of app
+    .fail_agent(agent=None) - move tasks of agent to other agents, return agent
+    .restart(app_id) - replace all tasks of app
+    .endpoints(name) - set of "<name> <agent>:<http port>" lines of app tasks
+    .apps(), .tasks() - Marathon API data
+    .srv(fqdn), .a(fqdn) - mesos-dns data
+    """
+
+    def __init__(self, agents, domain):
+        self.domain = domain
+        self._agents = ['agent{}.{}'.format(x, GROUP) for x in range(agents)]
+        self._apps = {}
+        self._tasks = {}
+        self._ids = itertools.count()
+        self._ports = itertools.count(31000)
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def _app_id(self, name):
+        return '/{0}/{1}'.format(GROUP, name)
+
+    def _start_task(self, app_id, exclude=()):
+        used = set([x['host'] for x in self._tasks.values() if x['appId'] == app_id]) | set(exclude)
+        free = [x for x in self._agents if x not in used]
+        if not free:
+            return None
+        task_id = '{0}.{1}'.format(app_id.strip('/').replace('/', '_'), next(self._ids))
+        self._tasks[task_id] = {'id': task_id,
+                                'appId': app_id,
+                                'host': random.choice(free),
+                                'ports': [next(self._ports) for x in PORTS],
+                                'servicePorts': self._apps[app_id]['servicePorts'],
+                                'state': 'TASK_RUNNING'}
+        return task_id
+
+    def add_app(self, name, instances):
+        with self._lock:
+            app_id = self._app_id(name)
+            service_ports = [10000 + len(self._apps) * len(PORTS) + i for i in range(len(PORTS))]
+            self._apps[app_id] = {'id': app_id,
+                                  'instances': 0,
+                                  'servicePorts': service_ports,
+                                  'container': {'type': 'DOCKER', 'docker': {'portMappings': [
+                                      {'name': x, 'protocol': 'tcp', 'servicePort': service_ports[i],
+                                       'containerPort': 0, 'hostPort': 0}
+                                      for i, x in enumerate(PORTS)]}}}
+        self.scale(name, instances)
+
+    def scale(self, name, delta):
+        with self._lock:
+            app_id = self._app_id(name)
+            if delta > 0:
+                for i in range(delta):
+                    self._start_task(app_id)
+            else:
+                tasks = sorted([x for x in self._tasks if self._tasks[x]['appId'] == app_id])
+                for task_id in tasks[:min(-delta, len(tasks) - 1)]:
+                    del self._tasks[task_id]
+            self._apps[app_id]['instances'] = len([x for x in self._tasks.values() if x['appId'] == app_id])
+            self.version += 1
+
+    def fail_agent(self, agent=None):
+        with self._lock:
+            if agent is None:
+                agent = random.choice(sorted(set([x['host'] for x in self._tasks.values()])))
+            for task_id in [x for x in self._tasks if self._tasks[x]['host'] == agent]:
+                app_id = self._tasks.pop(task_id)['appId']
+                self._start_task(app_id, exclude=[agent])
+            self.version += 1
+        return agent
+
+    def restart(self, app_id):
+        with self._lock:
+            if app_id not in self._apps:
+                return False
+            tasks = [x for x in self._tasks if self._tasks[x]['appId'] == app_id]
+            for task_id in tasks:
+                del self._tasks[task_id]
+            for task_id in tasks:
+                self._start_task(app_id)
+            self.version += 1
+            return True
+
+    def affected(self, agent):
+        with self._lock:
+            return set([x['appId'].split('/')[-1] for x in self._tasks.values() if x['host'] == agent])
+
+    def endpoints(self, name):
+        with self._lock:
+            app_id = self._app_id(name)
+            return set(['{0} {1}:{2}'.format(name, x['host'], x['ports'][0])
+                        for x in self._tasks.values() if x['appId'] == app_id])
+
+    def apps(self, embed=False):
+        with self._lock:
+            apps = []
+            for app in self._apps.values():
+                app = dict(app)
+                if embed:
+                    app['tasks'] = [dict(x) for x in self._tasks.values() if x['appId'] == app['id']]
+                apps.append(app)
+            return apps
+
+    def tasks(self):
+        with self._lock:
+            return [dict(x) for x in self._tasks.values()]
+
+    # SRV records of fqdn: list of (target, port)
+    def srv(self, fqdn):
+        labels = fqdn.rstrip('.').lower()
+        if not labels.endswith('._tcp.' + self.domain):
+            return []
+        parts = labels[:-len('._tcp.' + self.domain)].split('.')
+        if len(parts) == 3:
+            port_name, name, group = parts[0][1:], parts[1][1:], parts[2]
+        elif len(parts) == 2:
+            port_name, name, group = None, parts[0][1:], parts[1]
+        else:
+            return []
+        with self._lock:
+            app_id = '/{0}/{1}'.format(group, name)
+            records = []
+            for task in [x for x in self._tasks.values() if x['appId'] == app_id]:
+                for i, port in enumerate(PORTS):
+                    if port_name is None or port_name == port:
+                        records.append((task['host'], task['ports'][i]))
+            return records
+
+    def a(self, fqdn):
+        name = fqdn.rstrip('.').lower()
+        if name in self._agents:
+            return ['127.0.{0}.{1}'.format(self._agents.index(name) // 250, self._agents.index(name) % 250 + 1)]
+        return []
+
+
+class MarathonServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """ Marathon API of simulated cluster """
+    daemon_threads = True
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, code, data):
+            body = json.dumps(data).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            cluster = self.server.cluster
+            path, _, query = self.path.partition('?')
+            if path == '/v2/apps':
+                self._send(200, {'apps': cluster.apps(embed='embed=apps.tasks' in query)})
+            elif path == '/v2/tasks':
+                self._send(200, {'tasks': cluster.tasks()})
+            else:
+                self._send(404, {'message': 'Not found'})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                self.rfile.read(length)
+            path = self.path.partition('?')[0]
+            if path.startswith('/v2/apps/') and path.endswith('/restart'):
+                app_id = path[len('/v2/apps'):-len('/restart')]
+                if self.server.cluster.restart(app_id):
+                    self._send(200, {'deploymentId': str(self.server.cluster.version),
+                                     'version': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())})
+                    return
+                self._send(404, {'message': 'App "{}" does not exist'.format(app_id)})
+            else:
+                self._send(404, {'message': 'Not found'})
+
+    def __init__(self, cluster, host='127.0.0.1', port=0):
+        super().__init__((host, port), self.Handler)
+        self.cluster = cluster
+        self._thread = threading.Thread(target=self.serve_forever, name='sim-marathon')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.server_address)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class DNSServer(socketserver.ThreadingMixIn, socketserver.UDPServer):
+    """ Authoritative mesos-dns of simulated cluster """
+    daemon_threads = True
+
+    class Handler(socketserver.BaseRequestHandler):
+
+        def handle(self):
+            data, sock = self.request
+            cluster = self.server.cluster
+            try:
+                query = dns.message.from_wire(data)
+            except Exception:
+                return
+            response = dns.message.make_response(query)
+            response.flags |= dns.flags.AA
+            for question in query.question:
+                fqdn = question.name.to_text()
+                if question.rdtype == dns.rdatatype.SRV:
+                    records = ['0 1 {0} {1}.'.format(x[1], x[0]) for x in cluster.srv(fqdn)]
+                elif question.rdtype == dns.rdatatype.A:
+                    records = cluster.a(fqdn)
+                else:
+                    records = []
+                if records:
+                    response.answer.append(dns.rrset.from_text_list(
+                        question.name, self.server.ttl, 'IN', question.rdtype, records))
+                else:
+                    response.set_rcode(dns.rcode.NXDOMAIN)
+            sock.sendto(response.to_wire(), self.client_address)
+
+    def __init__(self, cluster, host='127.0.0.1', port=0, ttl=0):
+        super().__init__((host, port), self.Handler)
+        self.cluster = cluster
+        self.ttl = ttl
+        self._thread = threading.Thread(target=self.serve_forever, name='sim-dns')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+# Apply change of scenario to cluster
+# Return set of changed app names
+def apply_change(cluster, scenario, step, names):
+    if scenario == 'mixed':
+        scenario = SCENARIOS[step % (len(SCENARIOS) - 1)]
+    name = names[step % len(names)]
+    if scenario == 'scale-up':
+        cluster.scale(name, 1)
+        return set([name])
+    if scenario == 'scale-down':
+        cluster.scale(name, -1)
+        return set([name])
+    agent = random.choice(sorted(set([x['host'] for x in cluster.tasks()])))
+    affected = cluster.affected(agent)
+    cluster.fail_agent(agent)
+    return affected
+
+
+def read_lines(path):
+    try:
+        with open(path) as f:
+            return set([x for x in f.read().split('\n') if x])
+    except OSError:
+        return None
+
+
+def read_reloads(path):
+    try:
+        with open(path) as f:
+            return [float(x) for x in f.read().split() if x]
+    except (OSError, ValueError):
+        return []
+
+
+def summary(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    return {'count': len(values),
+            'min': values[0],
+            'p50': values[len(values) // 2],
+            'p95': values[min(int(len(values) * 0.95), len(values) - 1)],
+            'max': values[-1],
+            'mean': sum(values) / len(values)}
+
+
+class Driver:
+    """ Run surok.py against simulator and measure change latencies """
+
+    def __init__(self, args):
+        self._args = args
+        self._root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self._workdir = tempfile.mkdtemp(prefix='surok-sim-')
+        self._names = ['app{}'.format(x) for x in range(args.apps)]
+        self._pending = {}
+        self._file_latency = []
+        self._reload_latency = []
+        self._superseded = 0
+        self._timeouts = 0
+        self._lock = threading.Lock()
+
+    def _path(self, *names):
+        return os.path.join(self._workdir, *names)
+
+    def _write_configs(self, marathon, dns_server):
+        args = self._args
+        os.mkdir(self._path('conf.d'))
+        os.mkdir(self._path('out'))
+        for name in self._names:
+            with open(self._path('conf.d', name + '.json'), 'w') as f:
+                json.dump({'conf_name': name,
+                           'services': [{'name': name, 'tcp': ['http']}],
+                           'group': GROUP,
+                           'files': {self._path('out', name + '.conf'): TEMPLATE},
+                           'reload_cmd': 'date +%s.%N >> {}'.format(self._path('out', name + '.reloads'))},
+                          f)
+        with open(self._path('surok.json'), 'w') as f:
+            json.dump({'version': '0.8',
+                       'marathon': {'enabled': args.discovery == 'marathon_api',
+                                    'host': marathon.url(), 'restart': False},
+                       'mesos': {'enabled': args.discovery == 'mesos_dns', 'domain': args.domain},
+                       'dns': {'nameservers': [dns_server.server_address[0]],
+                               'port': dns_server.server_address[1]},
+                       'default_discovery': args.discovery,
+                       'confd': self._path('conf.d'),
+                       'modules': os.path.join(self._root, 'modules'),
+                       'wait_time': args.wait_time,
+                       'loglevel': 'warning',
+                       'memcached': {'enabled': False, 'discovery': {'enabled': False}}},
+                      f)
+
+    # Track changed apps until file has new endpoints and reload_cmd is completed
+    def _track(self, changed, start):
+        with self._lock:
+            for name in changed:
+                if name in self._pending:
+                    self._superseded += 1
+                self._pending[name] = {'start': start,
+                                       'expected': self._cluster.endpoints(name),
+                                       'file': None}
+
+    def _poll(self):
+        while not self._stop.is_set() or self._pending:
+            now = time.time()
+            with self._lock:
+                for name in list(self._pending):
+                    pending = self._pending[name]
+                    if pending['file'] is None:
+                        path = self._path('out', name + '.conf')
+                        if read_lines(path) == pending['expected']:
+                            # File is rewritten atomically, its mtime is time of change
+                            pending['file'] = max(os.stat(path).st_mtime, pending['start'])
+                            self._file_latency.append(pending['file'] - pending['start'])
+                    if pending['file'] is not None:
+                        reloads = [x for x in read_reloads(self._path('out', name + '.reloads'))
+                                   if x >= pending['file']]
+                        if reloads:
+                            self._reload_latency.append(reloads[0] - pending['start'])
+                            del self._pending[name]
+                            continue
+                    if now - pending['start'] > self._args.timeout:
+                        self._timeouts += 1
+                        del self._pending[name]
+            if self._stop.is_set() and time.time() > self._deadline:
+                break
+            time.sleep(self._args.poll)
+
+    def run(self):
+        args = self._args
+        self._cluster = Cluster(args.agents, args.domain)
+        for name in self._names:
+            self._cluster.add_app(name, args.instances)
+        marathon = MarathonServer(self._cluster)
+        dns_server = DNSServer(self._cluster, ttl=args.ttl)
+        surok = None
+        try:
+            self._write_configs(marathon, dns_server)
+            log = open(self._path('surok.log'), 'w')
+            surok = subprocess.Popen([sys.executable, 'surok.py', '-c', self._path('surok.json')],
+                                     cwd=self._root, stdout=log, stderr=subprocess.STDOUT)
+            # Initial render of all apps
+            self._stop = threading.Event()
+            self._deadline = 0
+            self._track(self._names, time.time())
+            self._poll_thread = threading.Thread(target=self._poll, name='sim-poll')
+            self._poll_thread.daemon = True
+            self._poll_thread.start()
+            while self._pending and surok.poll() is None:
+                time.sleep(args.poll)
+            with self._lock:
+                self._file_latency = []
+                self._reload_latency = []
+                self._superseded = 0
+            # Scenario changes at rate
+            start = time.time()
+            for step in range(args.changes):
+                delay = start + step / args.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                now = time.time()
+                self._track(apply_change(self._cluster, args.scenario, step, self._names), now)
+            self._deadline = time.time() + args.timeout
+            self._stop.set()
+            self._poll_thread.join()
+        finally:
+            if surok is not None:
+                surok.terminate()
+                surok.wait()
+            marathon.stop()
+            dns_server.stop()
+        with self._lock:
+            timeouts = self._timeouts + len(self._pending)
+        result = {'scenario': args.scenario,
+                  'discovery': args.discovery,
+                  'rate': args.rate,
+                  'changes': args.changes,
+                  'apps': args.apps,
+                  'file': summary(self._file_latency),
+                  'reload': summary(self._reload_latency),
+                  'superseded': self._superseded,
+                  'timeouts': timeouts}
+        if args.keep:
+            result['workdir'] = self._workdir
+        else:
+            shutil.rmtree(self._workdir, ignore_errors=True)
+        return result
+
+
+def serve(args):
+    cluster = Cluster(args.agents, args.domain)
+    names = ['app{}'.format(x) for x in range(args.apps)]
+    for name in names:
+        cluster.add_app(name, args.instances)
+    marathon = MarathonServer(cluster, port=args.marathon_port)
+    dns_server = DNSServer(cluster, port=args.dns_port, ttl=args.ttl)
+    print('Marathon: {0}, mesos-dns: {1}:{2}, domain: {3}'.format(
+        marathon.url(), dns_server.server_address[0], dns_server.server_address[1], args.domain),
+        file=sys.stderr)
+    try:
+        step = 0
+        while args.changes == 0 or step < args.changes:
+            time.sleep(1 / args.rate)
+            changed = apply_change(cluster, args.scenario, step, names)
+            print('Change {0}: {1} {2}'.format(step, args.scenario, sorted(changed)), file=sys.stderr)
+            step += 1
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        marathon.stop()
+        dns_server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local Marathon and mesos-dns simulator')
+    parser.add_argument('--scenario', choices=SCENARIOS, default='mixed')
+    parser.add_argument('--discovery', choices=['marathon_api', 'mesos_dns'], default='marathon_api')
+    parser.add_argument('--rate', type=float, default=1.0, help='changes per second')
+    parser.add_argument('--changes', type=int, default=10, help='count of changes, 0 - endless with --serve')
+    parser.add_argument('--apps', type=int, default=10, help='simulated apps and surok app configs')
+    parser.add_argument('--instances', type=int, default=3, help='initial tasks of every app')
+    parser.add_argument('--agents', type=int, default=20, help='simulated agents')
+    parser.add_argument('--domain', default='marathon.mesos', help='mesos-dns domain')
+    parser.add_argument('--ttl', type=int, default=0, help='TTL of DNS answers')
+    parser.add_argument('--wait-time', type=int, default=1, help='surok "wait_time"')
+    parser.add_argument('--timeout', type=float, default=30, help='max seconds from change to reload')
+    parser.add_argument('--poll', type=float, default=0.01, help='seconds between checks of files')
+    parser.add_argument('-o', '--output', default='-', help='results JSON path, "-" for stdout')
+    parser.add_argument('--keep', action='store_true', help='keep configs, outputs and surok log')
+    parser.add_argument('--serve', action='store_true', help='run simulator only, without driver')
+    parser.add_argument('--marathon-port', type=int, default=8080, help='Marathon port with --serve')
+    parser.add_argument('--dns-port', type=int, default=8053, help='mesos-dns port with --serve')
+    args = parser.parse_args()
+    if args.instances > args.agents:
+        parser.error('--instances must not be greater than --agents')
+
+    if args.serve:
+        serve(args)
+        return
+    result = Driver(args).run()
+    if args.output == '-':
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,11 +5,29 @@ import os
 import re
 import sys
 import hashlib
+import time
+import queue
+import threading
+import http.server
+import socketserver
+import tempfile
+import shutil
+import sqlite3
+import socket
+import urllib.request
+import dns.message
+import dns.rrset
 import surok.apps
 import surok.config
 import surok.logger
 import surok.discovery
 import surok.store
+import surok.templates
+import surok.watcher
+import surok.writer
+import surok.reloader
+import surok.metrics
+import surok.profiler
 
 class Logger(surok.logger.Logger):
     _out=''
@@ -167,6 +185,80 @@ class LoadModules(surok.apps.LoadModules):
             surok.apps.LoadModules._instance = cls._instance
         return cls._instance
 
+class MarathonStub(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """ Local Marathon API stub with events stream
+    ==================================================
+    .apps, .tasks - data for /v2/apps, /v2/tasks
+    .requests - list of requested paths
+    .send(event, data) - send event to /v2/events subscribers
+    """
+    daemon_threads = True
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _write_chunk(self, data):
+            data = data.encode()
+            self.wfile.write('{0:x}\r\n'.format(len(data)).encode() + data + b'\r\n')
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path == '/v2/events':
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                self._write_chunk(': connected\n\n')
+                while True:
+                    event = self.server.events.get()
+                    if event is None:
+                        self.wfile.write(b'0\r\n\r\n')
+                        return
+                    self._write_chunk('event: {0}\ndata: {1}\n\n'.format(event[0], json.dumps(event[1])))
+            else:
+                self.server.requests.append(self.path)
+                apps = self.server.apps
+                if self.path == '/v2/apps?embed=apps.tasks':
+                    apps = [dict(x, tasks=[y for y in self.server.tasks if y['appId'] == x['id']]) for x in apps]
+                data = {'/v2/apps': {'apps': apps},
+                        '/v2/tasks': {'tasks': self.server.tasks}}.get(self.path.split('?')[0])
+                body = json.dumps(data).encode()
+                self.send_response(200 if data is not None else 404)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), self.Handler)
+        self.apps = []
+        self.tasks = []
+        self.requests = []
+        self.events = queue.Queue()
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def host(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_port)
+
+    def send(self, event, data):
+        self.events.put((event, data))
+
+    def stop(self):
+        self.events.put(None)
+        self.shutdown()
+        self.server_close()
+
+def wait_for(test, timeout=5):
+    stop = time.time() + timeout
+    while not test() and time.time() < stop:
+        time.sleep(0.01)
+    return test()
+
 class Test01_Logger(unittest.TestCase):
     def test_01_logger_default_level(self):
         logger = Logger()
@@ -227,8 +319,8 @@ class Test02_LoadConfig(unittest.TestCase):
 
     def test_02_main_conf_loader(self):
         tests = {
-            '6a6d3844e6964f6be2418b7439169632d626f638': '/usr/share/surok/conf/surok_07.json',
-            'ac17e62f9082ea5d3fca614ecb75a4da271cfd8b': '/usr/share/surok/conf/surok_08.json',
+            'ee9a671d85229026d74da777bbec8fed3a1672d5': '/usr/share/surok/conf/surok_07.json',
+            'ff35b5fd16cf77f7b9bc9e69e5a2a360e3e429b6': '/usr/share/surok/conf/surok_08.json',
         }
         for test in tests.keys():
             logger = Logger('info')
@@ -306,6 +398,34 @@ class Test02_LoadConfig(unittest.TestCase):
             config.set(name01,oldvalue)
         config.clear()
 
+    def test_05_incremental_apps_reload(self):
+        def write_conf(path, data):
+            f = open(path, 'w')
+            f.write(json.dumps(data))
+            f.close()
+
+        confd = tempfile.mkdtemp()
+        write_conf(os.path.join(confd, 'app1.json'), {'reload_cmd': '/bin/true'})
+        write_conf(os.path.join(confd, 'app2.json'), {'reload_cmd': '/bin/true'})
+        config = Config({'confd': confd})
+        with self.subTest(msg="Testing apps config first load..."):
+            self.assertEqual(config.update_apps(), {'app1.json', 'app2.json'})
+        app1 = config.apps['app1.json']
+        with self.subTest(msg="Testing apps config reload without changes..."):
+            self.assertEqual(config.update_apps(), set())
+            self.assertIs(config.apps['app1.json'], app1)
+        write_conf(os.path.join(confd, 'app2.json'), {'reload_cmd': '/bin/false'})
+        with self.subTest(msg="Testing apps config reload with changed file..."):
+            self.assertEqual(config.update_apps(), {'app2.json'})
+            self.assertIs(config.apps['app1.json'], app1)
+            self.assertEqual(config.apps['app2.json']['reload_cmd'], '/bin/false')
+        os.remove(os.path.join(confd, 'app1.json'))
+        with self.subTest(msg="Testing apps config reload with removed file..."):
+            self.assertEqual(config.update_apps(), {'app1.json'})
+            self.assertEqual(list(config.apps.keys()), ['app2.json'])
+        shutil.rmtree(confd)
+        config.clear()
+
 class Test03_Discovery(unittest.TestCase):
 
     def test_01_discovery(self):
@@ -465,6 +585,304 @@ class Test03_Discovery(unittest.TestCase):
 
         config.clear()
 
+    def test_02_discovery_mesos_workers(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        config['env'] = {'SUROK_DISCOVERY_GROUP': 'xxx.yyy'}
+        config['default_discovery'] = 'mesos_dns'
+        config['mesos']['enabled'] = True
+        discovery = Discovery()
+        results = {}
+        for workers in [1, 4]:
+            config['mesos']['workers'] = workers
+            config.update_apps()
+            discovery.update_data()
+            results[workers] = json.dumps(dict([(x, discovery.resolve(config.apps[x])) for x in config.apps]),
+                                          sort_keys=True)
+        with self.subTest(msg="Testing concurrent mesos discovery...\nSerial:\n{0}\nConcurrent:\n{1}".format(results[1], results[4])):
+            self.assertEqual(results[1], results[4])
+        config.clear()
+
+    def test_03_dns_cache(self):
+        config = Config()
+        config['dns']['cache_size'] = 2
+        cache = surok.discovery.DNSCache()
+        cache.clear()
+        now = time.time()
+        cache.set('a.test', 'A', ['10.0.0.1'], now + 60)
+        cache.set('b.test', 'A', ['10.0.0.2'], now + 60)
+        cache.set('c.test', 'A', ['10.0.0.3'], now - 1)
+        with self.subTest(msg="Testing DNS cache get..."):
+            self.assertEqual(cache.get('a.test', 'A'), ['10.0.0.1'])
+            self.assertEqual(cache.get('A.TEST', 'A'), ['10.0.0.1'])
+            self.assertEqual(cache.get('a.test', 'SRV'), None)
+            self.assertEqual(cache.get('c.test', 'A'), None)
+        cache.set('d.test', 'A', ['10.0.0.4'], now + 60)
+        with self.subTest(msg="Testing DNS cache LRU eviction..."):
+            self.assertEqual(cache.get('b.test', 'A'), None)
+            self.assertEqual(cache.get('a.test', 'A'), ['10.0.0.1'])
+            self.assertEqual(cache.stats(), {'hits': 3, 'misses': 3, 'evictions': 1, 'entries': 2})
+        cache.clear()
+        config.clear()
+
+    def test_04_marathon_tasks_index(self):
+        marathon = surok.discovery.DiscoveryMarathon()
+        tasks = [{'appId': x, 'host': str(i)} for i, x in enumerate(
+            ['/yyy/xxx/zzy0', '/yyy/xxx/zzz0', '/yyy/xxx/zzy1', '/yyy/xxx/zzy0', '/yyy/xxxx/zzy0', '/yyy/xxx/zz'])]
+        marathon._tasks = tasks
+        for mask in ['/yyy/xxx/zzy0', '/yyy/xxx/zzy*', '/yyy/xxx/*', '/yyy/xxx*', '/yyy/xxx/zz', '/yyy/xxx/zzw*', '*']:
+            with self.subTest(msg="Testing Marathon tasks index...", mask=mask):
+                self.assertEqual(sorted([x['host'] for x in marathon._find_tasks(mask)]),
+                                 sorted([x['host'] for x in tasks if marathon._test_mask(mask, x['appId'])]))
+        index = marathon._index
+        marathon._find_tasks('/yyy/xxx/zzy0')
+        with self.subTest(msg="Testing Marathon tasks index is not rebuilt..."):
+            self.assertIs(marathon._index, index)
+            self.assertIs(index[0], tasks)
+        marathon._tasks = tasks[:1]
+        with self.subTest(msg="Testing Marathon tasks index is replaced with task list..."):
+            self.assertEqual(marathon._find_tasks('/yyy/xxx/zzy*'), tasks[:1])
+            self.assertIs(marathon._index[0], marathon._tasks)
+            self.assertEqual(marathon._index[2], ['/yyy/xxx/zzy0'])
+
+    def test_05_marathon_events(self):
+        stub = MarathonStub()
+        stub.apps = [{'id': '/yyy/xxx/zzy0',
+                      'container': {'type': 'DOCKER',
+                                    'docker': {'portMappings': [{'name': 'tname_aa',
+                                                                 'protocol': 'tcp',
+                                                                 'servicePort': 10000}]}}}]
+        stub.tasks = [{'id': 'zzy0.1', 'appId': '/yyy/xxx/zzy0', 'host': 'localhost',
+                       'ports': [31000], 'servicePorts': [10000]}]
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        config['marathon']['host'] = stub.host()
+        config['marathon']['events'] = True
+        marathon = surok.discovery.DiscoveryMarathon()
+        marathon.update_data()
+        with self.subTest(msg="Testing Marathon events stream connect and resync..."):
+            self.assertTrue(wait_for(lambda: marathon._events_connected))
+            self.assertEqual([x['id'] for x in marathon._tasks], ['zzy0.1'])
+        stub.send('status_update_event', {'eventType': 'status_update_event', 'taskId': 'zzy0.2',
+                                          'taskStatus': 'TASK_RUNNING', 'appId': '/yyy/xxx/zzy0',
+                                          'host': 'localhost', 'ports': [31001]})
+        with self.subTest(msg="Testing Marathon events stream task running..."):
+            self.assertTrue(wait_for(lambda: len(marathon._tasks) == 2))
+            self.assertEqual(marathon._tasks[1]['servicePorts'], [10000])
+            self.assertEqual(surok.discovery.Discovery().wait(1), True)
+        stub.send('status_update_event', {'eventType': 'status_update_event', 'taskId': 'zzy0.1',
+                                          'taskStatus': 'TASK_KILLED', 'appId': '/yyy/xxx/zzy0',
+                                          'host': 'localhost', 'ports': [31000]})
+        with self.subTest(msg="Testing Marathon events stream task killed..."):
+            self.assertTrue(wait_for(lambda: [x['id'] for x in marathon._tasks] == ['zzy0.2']))
+        config['marathon']['events'] = False
+        stub.stop()
+        config.clear()
+
+    def test_06_marathon_client(self):
+        stub = MarathonStub()
+        stub.apps = [{'id': '/yyy/xxx/zzy0'}]
+        stub.tasks = [{'id': 'zzy0.1', 'appId': '/yyy/xxx/zzy0', 'host': 'localhost',
+                       'ports': [31000], 'servicePorts': [10000]}]
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        config['marathon']['host'] = stub.host()
+        marathon = surok.discovery.DiscoveryMarathon()
+        marathon.update_data()
+        with self.subTest(msg="Testing Marathon apps with embedded tasks..."):
+            self.assertEqual(stub.requests, ['/v2/apps?embed=apps.tasks'])
+            self.assertEqual([x['id'] for x in marathon._tasks], ['zzy0.1'])
+        client = surok.discovery.MarathonClient()
+        with self.subTest(msg="Testing Marathon client skips unchanged data..."):
+            self.assertEqual(client.get('/v2/apps', {'embed': 'apps.tasks'}), None)
+            stub.tasks[0]['host'] = 'test.zzz0.test'
+            self.assertNotEqual(client.get('/v2/apps', {'embed': 'apps.tasks'}), None)
+        stub.stop()
+        config.clear()
+
+    def test_07_marathon_app_tasks(self):
+        marathon = DiscoveryMarathon()
+        marathon._ports = {'/yyy/xxx/zzy0': [{'name': 'tname_aa', 'protocol': 'tcp', 'servicePort': 10000},
+                                             {'name': 'tname_ab', 'protocol': 'udp', 'servicePort': 10001}]}
+        marathon._tasks = [{'appId': '/yyy/xxx/zzy0', 'host': host, 'ports': ports, 'servicePorts': [10000, 10001]}
+                           for host, ports in [('test.zzz0.test', [31000, 31100]), ('test.zzz1.test', [31001, 31101])]]
+        hosts = marathon.resolve({'conf_name': 'test', 'group': 'xxx.yyy',
+                                  'services': [{'name': 'zzy0', 'tcp': ['tname_aa'], 'udp': []}]})
+        with self.subTest(msg="Testing Marathon tasks of one app are merged...", hosts=hosts):
+            self.assertEqual(sorted([(x['name'], x['tcp']['tname_aa'], x['udp']) for x in hosts['zzy0']]),
+                             [('test.zzz0.test', 31000, [31100]), ('test.zzz1.test', 31001, [31101])])
+
+    def test_08_dns_nameservers(self):
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data, sock = self.request
+                query = dns.message.from_wire(data)
+                response = dns.message.make_response(query)
+                response.answer.append(dns.rrset.from_text(query.question[0].name, 0, 'IN', 'A', '10.9.9.9'))
+                sock.sendto(response.to_wire(), self.client_address)
+        server = socketserver.UDPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        config['dns']['nameservers'] = ['127.0.0.1']
+        config['dns']['port'] = server.server_address[1]
+        try:
+            with self.subTest(msg="Testing DNS nameservers and port..."):
+                self.assertEqual(surok.discovery.DiscoveryMesos().do_query_a('nameserver.test'), ['10.9.9.9'])
+            del config['dns']['nameservers']
+            del config['dns']['port']
+            with self.subTest(msg="Testing DNS servers of /etc/resolv.conf by default..."):
+                self.assertEqual(surok.discovery.DiscoveryMesos()._resolver().port, 53)
+        finally:
+            config['dns'].pop('nameservers', None)
+            config['dns'].pop('port', None)
+            server.shutdown()
+            server.server_close()
+            config.clear()
+
+    def test_09_discovery_dedup(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        config['mesos']['enabled'] = True
+        discovery = Discovery()
+        mesos = discovery._discoveries['mesos_dns']
+        mesos.update_data()
+        apps = [surok.config.AppConfig({'conf_name': 'dedup0', 'group': 'xxx.yyy',
+                                        'services': [{'name': 'zzy0', 'tcp': ['tname_aa', 'tname_ab']}]}),
+                surok.config.AppConfig({'conf_name': 'dedup1', 'group': 'xxx.yyy',
+                                        'services': [{'name': 'zzy0', 'tcp': ['tname_aa']},
+                                                     {'name': 'zzz1', 'tcp': []}]})]
+        expected = [discovery.compatible(mesos.resolve(x)) for x in apps]
+        queries = []
+        query_srv = mesos.do_query_srv
+        mesos.do_query_srv = lambda fqdn: queries.append(fqdn) or query_srv(fqdn)
+        try:
+            discovery.prefetch(apps)
+            results = [discovery.resolve(x) for x in apps + apps[1:]]
+            discovery.clear()
+        finally:
+            del mesos.do_query_srv
+        with self.subTest(msg="Testing shared services are resolved once...", queries=queries):
+            self.assertEqual(len(queries), 3)
+            self.assertEqual(len(set(queries)), 3)
+        with self.subTest(msg="Testing apps get own hosts...", results=results):
+            self.assertEqual(results, expected + expected[1:])
+            self.assertIsNot(results[1], results[2])
+        config.clear()
+
+    def test_10_marathon_events_timeout(self):
+        stub = MarathonStub()
+        stub.apps = [{'id': '/yyy/xxx/zzy0'}]
+        stub.tasks = [{'id': 'zzy0.1', 'appId': '/yyy/xxx/zzy0', 'host': 'localhost',
+                       'ports': [31000], 'servicePorts': [10000]}]
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        config['marathon']['host'] = stub.host()
+        config['marathon']['events'] = True
+        config['marathon']['events_timeout'] = 1
+        marathon = surok.discovery.DiscoveryMarathon()
+        marathon._events_retry = 0
+        marathon.update_data()
+        with self.subTest(msg="Testing silent Marathon events stream is reconnected with resync..."):
+            self.assertTrue(wait_for(lambda: marathon._events_connected))
+            requests = len(stub.requests)
+            self.assertTrue(wait_for(lambda: len(stub.requests) > requests))
+        config['marathon']['events'] = False
+        marathon._events_thread.join(5)
+        stub.stop()
+        config.clear()
+
+    def test_11_discovery_concurrent_resolve(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        config['mesos']['enabled'] = True
+        discovery = Discovery()
+        mesos = discovery._discoveries['mesos_dns']
+        mesos.update_data()
+        apps = [surok.config.AppConfig({'conf_name': 'slow', 'group': 'xxx.yyy',
+                                        'services': [{'name': 'zzy0', 'tcp': ['tname_aa']}]}),
+                surok.config.AppConfig({'conf_name': 'fast', 'group': 'xxx.yyy',
+                                        'services': [{'name': 'zzz1', 'tcp': []}]})]
+        expected = [discovery.compatible(mesos.resolve(x)) for x in apps]
+        release = threading.Event()
+        calls = []
+        resolve_units = mesos.resolve_units
+        def slow_resolve_units(services):
+            calls.append([x['name'] for x in services])
+            if 'zzy0' in calls[-1]:
+                release.wait(5)
+            return resolve_units(services)
+        mesos.resolve_units = slow_resolve_units
+        results = {}
+        def resolve(name, app):
+            results[name] = discovery.resolve(app)
+        threads = [threading.Thread(target=resolve, args=(x, apps[0])) for x in ('slow0', 'slow1')]
+        try:
+            discovery.prefetch([])
+            threads[0].start()
+            self.assertTrue(wait_for(lambda: calls))
+            threads[1].start()
+            with self.subTest(msg="Testing units are resolved without lock..."):
+                self.assertEqual(discovery.resolve(apps[1]), expected[1])
+                self.assertTrue(threads[1].is_alive())
+            release.set()
+            for thread in threads:
+                thread.join(5)
+            with self.subTest(msg="Testing readers wait for unit resolved by other thread...", calls=calls):
+                self.assertEqual(results, {'slow0': expected[0], 'slow1': expected[0]})
+                self.assertEqual(calls, [['zzy0'], ['zzz1']])
+        finally:
+            release.set()
+            del mesos.resolve_units
+            discovery.clear()
+            config.clear()
+
+    def test_12_marathon_deployment_ports(self):
+        stub = MarathonStub()
+        stub.apps = [{'id': '/yyy/xxx/zzy0',
+                      'container': {'type': 'DOCKER',
+                                    'docker': {'portMappings': [{'name': 'tname_aa',
+                                                                 'protocol': 'tcp',
+                                                                 'servicePort': 10000}]}}}]
+        stub.tasks = [{'id': 'zzy0.1', 'appId': '/yyy/xxx/zzy0', 'host': 'localhost',
+                       'ports': [31000], 'servicePorts': [10000]}]
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        config['marathon']['host'] = stub.host()
+        config['marathon']['events'] = True
+        logger = Logger()
+        marathon = surok.discovery.DiscoveryMarathon()
+        marathon.do_query_a = lambda fqdn: ['127.0.0.1']
+        marathon.update_data()
+        app = {'conf_name': 'deploy', 'group': 'xxx.yyy', 'services': [{'name': 'zzy0', 'tcp': ['tname_aa']}]}
+        try:
+            self.assertTrue(wait_for(lambda: marathon._events_connected))
+            stub.send('deployment_info', {'eventType': 'deployment_info',
+                                          'plan': {'target': {'apps': [dict(stub.apps[0], container={
+                                              'type': 'DOCKER',
+                                              'docker': {'portMappings': [{'name': 'tname_aa',
+                                                                           'protocol': 'tcp',
+                                                                           'servicePort': 10001}]}})]}}})
+            self.assertTrue(wait_for(lambda: marathon._ports['/yyy/xxx/zzy0'][0]['servicePort'] == 10001))
+            logger.reset()
+            with self.subTest(msg="Testing old tasks are skipped while app is deployed..."):
+                self.assertEqual(marathon.resolve(app), {'zzy0': []})
+                self.assertIn('Ports of task "zzy0.1" do not match ports of app "/yyy/xxx/zzy0"', logger.getout() + logger.geterr())
+        finally:
+            config['marathon']['events'] = False
+            stub.stop()
+            marathon._events_thread.join(5)
+            logger.reset()
+            config.clear()
+
+    def test_13_discovery_none(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        config['env'] = {}
+        logger = Logger()
+        logger.reset()
+        app = surok.config.AppConfig({'conf_name': 'none', 'discovery': 'none', 'services': [{'name': 'zzy0'}]})
+        discovery = Discovery()
+        with self.subTest(msg="Testing apps of none discovery without group..."):
+            self.assertEqual(app['group'], None)
+            self.assertEqual(discovery.resolve(app), {})
+            self.assertEqual(discovery.resolve_service(app, app['services'][0]), {})
+            self.assertNotIn(' ERROR: ', logger.getout() + logger.geterr())
+        config.clear()
+
 class Test04_Store(unittest.TestCase):
     def test01_Store_Objects(self):
         store = Store()
@@ -524,6 +942,11 @@ class Test04_Store(unittest.TestCase):
                 'enabled': True,
                 'name': 'memcached',
                 'store': surok.store.StoreMemcached()
+            },
+            {
+                'enabled': True,
+                'name': 'sqlite',
+                'store': surok.store.StoreSqlite()
             }
         ]
 
@@ -618,7 +1041,7 @@ class Test04_Store(unittest.TestCase):
         config = Config()
         with self.subTest(msg="Check logger ERR/OUT output for Store init...\nConfig:\n{0}".format(config.dump())):
             self.assertEqual(logger.getout() + logger.geterr(), '')
-        for conf_store in ['memory', 'files', 'memcached', 'memcached_discovery']:
+        for conf_store in ['memory', 'files', 'memcached', 'sqlite', 'memcached_discovery']:
             logger.reset()
             config.clear()
             config.set_config('/usr/share/surok/conf/surok_check.json')
@@ -633,7 +1056,7 @@ class Test04_Store(unittest.TestCase):
                 discovery = Discovery()
                 discovery.update_data()
             else:
-                if conf_store in ['files', 'memcached']:
+                if conf_store in ['files', 'memcached', 'sqlite']:
                     config[conf_store]['enabled'] = True
                 config['default_store'] = conf_store
                 if conf_store == 'memcached':
@@ -712,6 +1135,218 @@ class Test04_Store(unittest.TestCase):
                 self.assertEqual(output, '')
         config.clear()
 
+    def test03_Memcached_manifest(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        config['memcached']['enabled'] = True
+        config['memcached']['host'] = 'localhost:11211'
+        if os.environ.get('MEMCACHE_PORT'):
+            config['memcached']['host'] = os.environ['MEMCACHE_PORT'].split('/')[2]
+        config['memcached']['namespace'] = 'surok_test'
+        store = surok.store.StoreMemcached()
+        store.check()
+        other = surok.store.StoreMemcached()
+        other.check()
+        def no_stats(*args):
+            raise AssertionError('get_stats is called')
+        store._mc.get_stats = no_stats
+        gets = store._mc.gets
+        def concurrent_gets(key):
+            # Other client updates manifest between read and compare-and-swap
+            store._mc.gets = gets
+            data = gets(key)
+            other.set('other_key', {'hash': 'other'})
+            return data
+        store._mc.gets = concurrent_gets
+        try:
+            store.set('test_key', {'hash': 'test'})
+            with self.subTest(msg="Testing manifest update with concurrent client..."):
+                self.assertEqual(sorted(store.keys()), ['other_key', 'test_key'])
+                self.assertEqual(store.get('test_key'), {'hash': 'test'})
+                self.assertEqual(json.loads(store._mc.get('surok_test:manifest'))['version'], 2)
+            store.delete('test_key')
+            other.delete('other_key')
+            with self.subTest(msg="Testing manifest update on delete..."):
+                self.assertEqual(store.keys(), [])
+                self.assertEqual(store.get('test_key'), None)
+        finally:
+            store._mc.delete('surok_test:manifest')
+            config['memcached'].pop('namespace')
+            config.clear()
+
+    def test04_Store_batch(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        config['memcached']['enabled'] = True
+        config['memcached']['host'] = 'localhost:11211'
+        if os.environ.get('MEMCACHE_PORT'):
+            config['memcached']['host'] = os.environ['MEMCACHE_PORT'].split('/')[2]
+        config['default_store'] = 'memcached'
+        store = Store()
+        store.check()
+        mc = store._stores['memcached']._mc
+        calls = []
+        for name in ('get', 'get_multi', 'set', 'set_multi', 'delete', 'delete_multi'):
+            def counter(*args, _name=name, _orig=getattr(mc, name)):
+                calls.append(_name)
+                return _orig(*args)
+            setattr(mc, name, counter)
+        temps = [{'dest': '/tmp/test_batch_{}'.format(i), 'value': 'data'} for i in range(10)]
+        try:
+            for cycle in range(2):
+                calls.clear()
+                store.prefetch(temps)
+                for temp in temps:
+                    self.assertEqual(store.check_update(temp), cycle == 0)
+                store.check()
+                store.clear()
+                with self.subTest(msg="Testing batched store requests...", calls=calls, cycle=cycle):
+                    self.assertEqual(calls, ['get_multi', 'set_multi'] if cycle == 0 else ['get_multi'])
+            calls.clear()
+            store.clear()
+            with self.subTest(msg="Testing batched delete of unused records...", calls=calls):
+                self.assertEqual(calls, ['get_multi', 'delete_multi'])
+                self.assertEqual(list(store.keys()), [])
+        finally:
+            for name in ('get', 'get_multi', 'set', 'set_multi', 'delete', 'delete_multi'):
+                delattr(mc, name)
+            config['default_store'] = 'memory'
+            config.clear()
+
+    def test05_StoreFiles_index(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        path = tempfile.mkdtemp()
+        config['files'] = {'enabled': True, 'path': path}
+        store = surok.store.StoreFiles()
+        try:
+            store.check()
+            store.set('key1', {'hash': '1'})
+            with open(os.path.join(path, 'key1.surok'), 'w') as f:
+                f.write('{"hash": "changed in place"}')
+            with self.subTest(msg="Testing get from index without reading files..."):
+                self.assertEqual(store.get('key1'), {'hash': '1'})
+                self.assertEqual(store.keys(), ['key1'])
+            with open(os.path.join(path, 'key2.surok'), 'w') as f:
+                f.write('{"hash": "2"}')
+            os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1000000))
+            store.check()
+            with self.subTest(msg="Testing reload of index after directory change..."):
+                self.assertEqual(sorted(store.keys()), ['key1', 'key2'])
+                self.assertEqual(store.get('key2'), {'hash': '2'})
+            store.delete('key1')
+            store.delete('key2')
+            with self.subTest(msg="Testing delete through index..."):
+                self.assertEqual(store.keys(), [])
+                self.assertEqual(os.listdir(path), [])
+        finally:
+            config['files'] = {'enabled': False, 'path': '/var/tmp'}
+            store.check()
+            shutil.rmtree(path)
+
+    def test06_StoreSqlite_transaction(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        path = tempfile.mkdtemp()
+        config['sqlite'] = {'enabled': True, 'path': os.path.join(path, 'surok.sqlite')}
+        config['default_store'] = 'sqlite'
+        store = Store()
+        try:
+            store.check()
+            temps = [{'dest': '/tmp/test_sqlite_{}'.format(i), 'value': 'data'} for i in range(3)]
+            store.prefetch(temps)
+            for temp in temps:
+                store.check_update(temp)
+            store.flush()
+            other = sqlite3.connect(config['sqlite']['path'])
+            with self.subTest(msg="Testing changes are not committed before end of cycle..."):
+                self.assertEqual(other.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+                self.assertEqual(other.execute('SELECT COUNT(*) FROM records').fetchone()[0], 0)
+            for temp in temps:
+                store.touch(temp)
+            store.clear()
+            with self.subTest(msg="Testing changes are committed at end of cycle..."):
+                self.assertEqual(other.execute('SELECT COUNT(*) FROM records').fetchone()[0], 3)
+            other.close()
+            store.check()
+            store.clear()
+            with self.subTest(msg="Testing unused records are deleted..."):
+                self.assertEqual(list(store.keys()), [])
+        finally:
+            config['sqlite'] = {'enabled': False, 'path': '/var/tmp/surok.sqlite'}
+            config['default_store'] = 'memory'
+            store.check()
+            shutil.rmtree(path)
+
+    def test07_Store_generations(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        config['default_store'] = 'memory'
+        config['gc_full_sweep'] = 1000
+        store = Store()
+        memory = store._stores['memory']
+        temps = [{'localid': 'test_gc_{}'.format(i), 'data': i} for i in range(3)]
+        try:
+            store._generation = 1
+            for temp in temps:
+                store.check_update(temp)
+            memory.set('unknown', {'hash': 'unknown'})
+            keys = store.keys
+            def no_keys():
+                raise AssertionError('Full sweep of stores')
+            store.keys = no_keys
+            store.clear()
+            store.check_update(temps[0])
+            store.clear()
+            with self.subTest(msg="Testing delete of records unused in last cycle..."):
+                self.assertEqual(store._live[store._normalize(temps[0])['hashid']][1], store._generation)
+                self.assertEqual([x for x in memory.keys() if x in [store._normalize(y)['hashid'] for y in temps]],
+                                 [store._normalize(temps[0])['hashid']])
+                self.assertIn('unknown', memory.keys())
+            del store.keys
+            store._generation = 1000
+            store.clear()
+            with self.subTest(msg="Testing full sweep of stores..."):
+                self.assertNotIn('unknown', memory.keys())
+                self.assertEqual(store._live, {})
+        finally:
+            if 'keys' in store.__dict__:
+                del store.keys
+            config['gc_full_sweep'] = 100
+            config.clear()
+
+    def test08_Memcached_manifest_batch(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        config['memcached']['enabled'] = True
+        config['memcached']['host'] = 'localhost:11211'
+        if os.environ.get('MEMCACHE_PORT'):
+            config['memcached']['host'] = os.environ['MEMCACHE_PORT'].split('/')[2]
+        config['memcached']['namespace'] = 'surok_test_batch'
+        old_key = hashlib.sha1(b'/tmp/surok_old_record').hexdigest()
+        new_keys = [hashlib.sha1(x.encode()).hexdigest() for x in ('/tmp/surok_new_0', '/tmp/surok_new_1')]
+        store = surok.store.StoreMemcached()
+        store.check()
+        store._mc.set(old_key, json.dumps({'hash': 'old'}))
+        store._mc.set('surok_test_batch:other', 'not a record')
+        requests = []
+        gets, cas = store._mc.gets, store._mc.cas
+        store._mc.gets = lambda key: requests.append('gets') or gets(key)
+        store._mc.cas = lambda key, value: requests.append('cas') or cas(key, value)
+        try:
+            store.begin()
+            store.set_multi(dict([(x, {'hash': x}) for x in new_keys]))
+            store.delete_multi(new_keys[1:])
+            with self.subTest(msg="Testing manifest is not updated before commit...", requests=requests):
+                self.assertEqual(requests, [])
+            store.commit()
+            manifest = json.loads(gets('surok_test_batch:manifest'))
+            with self.subTest(msg="Testing manifest is updated once and seeded with older records..."):
+                self.assertIn(old_key, manifest['keys'])
+                self.assertIn(new_keys[0], manifest['keys'])
+                self.assertNotIn(new_keys[1], manifest['keys'])
+                self.assertNotIn('surok_test_batch:other', manifest['keys'])
+                self.assertEqual(store.keys(), manifest['keys'])
+                self.assertNotIn('cas', requests[:-1])
+        finally:
+            store._mc.delete_multi([old_key, 'surok_test_batch:other', 'surok_test_batch:manifest'] + new_keys)
+            config['memcached'].pop('namespace')
+            config.clear()
+
 class Test05_Apps(unittest.TestCase):
     def test01_Apps(self):
         def get_file(path):
@@ -733,6 +1368,7 @@ class Test05_Apps(unittest.TestCase):
         logger.reset()
         apps = surok.apps.Apps()
         apps.update()
+        surok.reloader.Reloader().join(10)
         tests = {
             '/tmp/test_1': '162165ae96553d94b803728bb870e571c304de5d',
             '/tmp/test_2': 'e899d5ee7c5dd11e614a7c67abbb47f3ab1646fc',
@@ -756,6 +1392,7 @@ class Test05_Apps(unittest.TestCase):
 
         config.set_config({'confd': '/usr/share/surok/conf.d_2'})
         apps.update()
+        surok.reloader.Reloader().join(10)
         for file_name in tests_2:
             data = get_file(file_name)
             with self.subTest(msg="Testing result for Apps object...\nFile:\n{0}\nData:\n{1}".format(file_name, data)):
@@ -769,6 +1406,510 @@ class Test05_Apps(unittest.TestCase):
             self.assertNotIn(' ERROR: ', output)
             self.assertNotIn(' WARNING: ', output)
 
+    def test02_Apps_skip_render(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        config['marathon']['enabled'] = True
+        config['mesos']['enabled'] = True
+        config['env'] = {'SUROK_DISCOVERY_GROUP': 'xxx.yyy'}
+        config['force_render'] = 1000
+        apps = surok.apps.Apps()
+        renders = []
+        render = surok.apps._render
+        surok.apps._render = lambda context, temp: renders.append(context._my['conf_name']) or render(context, temp)
+        for i in range(3):
+            renders.clear()
+            apps.update()
+        with self.subTest(msg="Testing skip render for unchanged apps...", renders=renders):
+            self.assertEqual(renders, [])
+            self.assertTrue(os.path.isfile('/tmp/test_1'))
+        os.utime('/usr/share/surok/templates/marathon_check.jj2')
+        apps.update()
+        with self.subTest(msg="Testing render for apps with changed template...", renders=renders):
+            self.assertIn('marathon_check.json', renders)
+            self.assertNotIn('self_check.json', renders)
+        surok.apps._render = render
+        config.clear()
+
+    def test03_Apps_refresh_interval(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        confd = tempfile.mkdtemp()
+        try:
+            for name, interval in (('fast', 1), ('slow', 1000)):
+                with open(os.path.join(confd, name + '.json'), 'w') as f:
+                    json.dump({'conf_name': name, 'services': [], 'refresh_interval': interval,
+                               'files': {os.path.join(confd, name + '.out'): '{{ my["conf_name"] }}'}}, f)
+            config.set_config({'confd': confd, 'wait_time': 1000, 'force_render': 0})
+            apps = surok.apps.Apps()
+            renders = []
+            render = surok.apps._render
+            surok.apps._render = lambda context, temp: renders.append(context._my['conf_name']) or render(context, temp)
+            start = time.time()
+            apps.update()
+            with self.subTest(msg="Testing first refresh of all apps...", renders=renders):
+                self.assertEqual(sorted(set(renders)), ['fast', 'slow'])
+                self.assertEqual(apps.lags(), {'fast': 0, 'slow': 0})
+            with self.subTest(msg="Testing first refreshes are spread across interval..."):
+                self.assertLess(apps._due['fast'], start + 1)
+            renders.clear()
+            apps.update(force_refresh=False)
+            with self.subTest(msg="Testing no refresh before interval...", renders=renders):
+                self.assertEqual(renders, [])
+                start = time.time()
+                apps.wait(1000)
+                self.assertLess(time.time() - start, 1.5)
+            time.sleep(1.1)
+            apps.update(force_refresh=False)
+            with self.subTest(msg="Testing refresh of due app only...", renders=renders):
+                self.assertEqual(sorted(set(renders)), ['fast'])
+                self.assertTrue(os.path.isfile(os.path.join(confd, 'slow.out')))
+            with self.subTest(msg="Testing app refresh lag..."):
+                self.assertGreater(apps.lags()['fast'], 0)
+                self.assertIn('surok_app_lag_seconds{app="fast"} ', surok.metrics.Metrics().render())
+        finally:
+            surok.apps._render = render
+            config.clear()
+            shutil.rmtree(confd)
+
+    def test04_Apps_parallel_render(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        confd = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(confd, 'broken.json'), 'w') as f:
+                json.dump({'conf_name': 'broken', 'services': [],
+                           'files': {os.path.join(confd, 'broken.out'): '{{ mod.from_file("/nonexistent") }}'}}, f)
+            for executor in ('thread', 'process'):
+                for i in range(4):
+                    with open(os.path.join(confd, 'app{}.json'.format(i)), 'w') as f:
+                        json.dump({'conf_name': 'app{}'.format(i), 'services': [],
+                                   'environments': {'TEST_APP{}'.format(i): executor + ' {{ my["conf_name"] }}'},
+                                   'files': {os.path.join(confd, '{0}{1}.out'.format(executor, i)):
+                                             '{{ my["conf_name"] }} {{ my["env"]["TEST_APP%d"] }}' % i}}, f)
+                config.set_config({'confd': confd, 'force_render': 0,
+                                   'templates': {'workers': 4, 'executor': executor}})
+                surok.apps.Apps().update()
+                for i in range(4):
+                    with self.subTest(msg="Testing parallel render of apps...", executor=executor, app=i):
+                        with open(os.path.join(confd, '{0}{1}.out'.format(executor, i))) as f:
+                            self.assertEqual(f.read(), 'app{0} {1} app{0}'.format(i, executor))
+                        self.assertEqual(os.environ.get('TEST_APP{}'.format(i)), '{0} app{1}'.format(executor, i))
+        finally:
+            config.set_config({'templates': {'workers': 1}})
+            config.clear()
+            shutil.rmtree(confd)
+
+    def test05_Apps_hash_once(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        confd = tempfile.mkdtemp()
+        dest = os.path.join(confd, 'hash.out')
+        hashed = []
+        class CountingHash:
+            def __init__(self, data=b''):
+                self._hash = hashlib.new('blake2b')
+                self.update(data)
+            def update(self, data):
+                hashed.append(len(data))
+                self._hash.update(data)
+            def hexdigest(self):
+                return self._hash.hexdigest()
+        patched = (surok.apps, surok.store, surok.writer)
+        orig = [x.new_hash for x in patched]
+        try:
+            with open(os.path.join(confd, 'hash.json'), 'w') as f:
+                json.dump({'conf_name': 'hash', 'services': [],
+                           'files': {dest: '{% for i in range(100) %}0123456789{% endfor %}'}}, f)
+            config.set_config({'confd': confd, 'force_render': 0, 'hash_algorithm': 'blake2b'})
+            for module in patched:
+                module.new_hash = CountingHash
+            surok.apps.Apps().update()
+            record = Store().get({'dest': dest})
+            with self.subTest(msg="Testing rendered output is hashed once...", hashed=hashed):
+                self.assertEqual(sum(hashed), 1000)
+                self.assertEqual(record['hash'], hashlib.blake2b(b'0123456789' * 100).hexdigest())
+        finally:
+            for module, new_hash in zip(patched, orig):
+                module.new_hash = new_hash
+            config.set_config({'hash_algorithm': 'sha1'})
+            config.clear()
+            shutil.rmtree(confd)
+
+    def test06_Apps_lazy_services(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        config['mesos']['enabled'] = True
+        tmp = tempfile.mkdtemp()
+        confd = os.path.join(tmp, 'conf.d')
+        os.mkdir(confd)
+        dest = os.path.join(tmp, 'lazy.out')
+        discovery = Discovery()
+        resolved = []
+        resolve_service = discovery.resolve_service
+        discovery.resolve_service = lambda app, service: resolved.append(service['name']) or resolve_service(app, service)
+        try:
+            with open(os.path.join(confd, 'lazy.json'), 'w') as f:
+                json.dump({'conf_name': 'lazy', 'group': 'xxx.yyy', 'discovery': 'mesos_dns',
+                           'services': [{'name': 'zzy0', 'tcp': ['tname_aa']}, {'name': 'zzz1', 'tcp': []}],
+                           'files': {dest: "{% if 'zzy0' in my['services'] %}"
+                                           "{{ my['services']['zzy0'][0]['tcp']['tname_aa'] }}"
+                                           "{% else %}{{ my['services']['zzz1'] }}{% endif %}"}}, f)
+            config.set_config({'confd': confd, 'force_render': 0})
+            apps = surok.apps.Apps()
+            apps.update()
+            with open(dest) as f:
+                output = f.read()
+            with self.subTest(msg="Testing unused services are not resolved...", resolved=resolved):
+                self.assertEqual(output, '12341')
+                self.assertEqual(resolved, ['zzy0'])
+                self.assertEqual(apps.used_services(), {'lazy': ['zzy0']})
+            resolved.clear()
+            apps.update()
+            with self.subTest(msg="Testing only used services are checked on skip render...", resolved=resolved):
+                self.assertEqual(resolved, ['zzy0'])
+                self.assertEqual(apps.used_services(), {'lazy': ['zzy0']})
+        finally:
+            del discovery.resolve_service
+            config.clear()
+            shutil.rmtree(tmp)
+
+    def test07_Apps_discovery_events(self):
+        stub = MarathonStub()
+        stub.apps = [{'id': '/yyy/xxx/zzy0',
+                      'container': {'type': 'DOCKER',
+                                    'docker': {'portMappings': [{'name': 'tname_aa',
+                                                                 'protocol': 'tcp',
+                                                                 'servicePort': 10000}]}}}]
+        stub.tasks = [{'id': 'zzy0.1', 'appId': '/yyy/xxx/zzy0', 'host': 'test.zzz0.test',
+                       'ports': [31000], 'servicePorts': [10000]}]
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        tmp = tempfile.mkdtemp()
+        confd = os.path.join(tmp, 'conf.d')
+        os.mkdir(confd)
+        dest = os.path.join(tmp, 'events.out')
+        discovery = Discovery()
+        testing = discovery._discoveries['marathon_api']
+        marathon = surok.discovery.DiscoveryMarathon()
+        marathon.do_query_a = lambda fqdn: ['127.0.0.1']
+        discovery._discoveries['marathon_api'] = marathon
+        try:
+            with open(os.path.join(confd, 'events.json'), 'w') as f:
+                json.dump({'conf_name': 'events', 'group': 'xxx.yyy', 'discovery': 'marathon_api',
+                           'services': [{'name': 'zzy0', 'tcp': ['tname_aa']}],
+                           'files': {dest: "{% for x in my['services']['zzy0'] %}"
+                                           "{{ x['tcp']['tname_aa'] }} {% endfor %}"}}, f)
+            config.set_config({'confd': confd, 'wait_time': 1000, 'force_render': 1000,
+                               'marathon': {'enabled': True, 'host': stub.host(), 'events': True}})
+            apps = surok.apps.Apps()
+            apps.update()
+            with self.subTest(msg="Testing render of Marathon app..."):
+                self.assertTrue(wait_for(lambda: marathon._events_connected))
+                with open(dest) as f:
+                    self.assertEqual(f.read(), '31000 ')
+            stub.send('status_update_event', {'eventType': 'status_update_event', 'taskId': 'zzy0.1',
+                                              'taskStatus': 'TASK_KILLED', 'appId': '/yyy/xxx/zzy0',
+                                              'host': 'test.zzz0.test', 'ports': [31000]})
+            with self.subTest(msg="Testing render on Marathon event before wait_time..."):
+                self.assertTrue(wait_for(lambda: marathon._tasks == []))
+                start = time.time()
+                self.assertTrue(apps.wait(1000))
+                apps.update(force_refresh=False)
+                self.assertLess(time.time() - start, 5)
+                with open(dest) as f:
+                    self.assertEqual(f.read(), '')
+        finally:
+            config['marathon']['events'] = False
+            stub.stop()
+            discovery._discoveries['marathon_api'] = testing
+            config.clear()
+            shutil.rmtree(tmp)
+
+    def test08_Apps_discovery_error(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        config['mesos']['enabled'] = True
+        tmp = tempfile.mkdtemp()
+        confd = os.path.join(tmp, 'conf.d')
+        os.mkdir(confd)
+        dest = os.path.join(tmp, 'error.out')
+        mesos = Discovery()._discoveries['mesos_dns']
+        mesos.update_data()
+        def resolve_units(services):
+            raise RuntimeError('resolve failed')
+        try:
+            with open(os.path.join(confd, 'error.json'), 'w') as f:
+                json.dump({'conf_name': 'error', 'group': 'xxx.yyy', 'discovery': 'mesos_dns',
+                           'services': [{'name': 'zzy0', 'tcp': ['tname_aa']}],
+                           'files': {dest: "{{ my['services']['zzy0'][0]['tcp']['tname_aa'] }}"}}, f)
+            config.set_config({'confd': confd, 'force_render': 1000})
+            apps = surok.apps.Apps()
+            apps.update()
+            mesos.resolve_units = resolve_units
+            apps.update()
+            with self.subTest(msg="Testing failed resolve keeps outputs of app..."):
+                with open(dest) as f:
+                    self.assertEqual(f.read(), '12341')
+        finally:
+            mesos.__dict__.pop('resolve_units', None)
+            Logger().reset()
+            config.clear()
+            shutil.rmtree(tmp)
+
+    def test09_Apps_services_names(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        config['marathon']['enabled'] = True
+        discovery = Discovery()
+        marathon = discovery._discoveries['marathon_api']
+        marathon.update_data()
+        tasks, ports = marathon._tasks, marathon._ports
+        marathon._ports = dict([(x, [{'name': 'tname_aa', 'protocol': 'tcp', 'servicePort': 10000}])
+                                for x in ['/yyy/xxx/sub/zzy0', '/yyy/xxx/hosts', '/yyy/xxx/used']])
+        marathon._tasks = [{'id': x + '.1', 'appId': '/yyy/xxx/' + x, 'host': 'test.zzz0.test',
+                            'ports': [port], 'servicePorts': [10000]}
+                           for x, port in [('sub/zzy0', 31000), ('hosts', 31001), ('used', 31002)]]
+        app = surok.config.AppConfig({'conf_name': 'names', 'group': 'xxx.yyy', 'discovery': 'marathon_api',
+                                      'services': [{'name': x, 'tcp': ['tname_aa']}
+                                                   for x in ['sub/zzy0', 'hosts', 'used']]})
+        try:
+            services = surok.apps._Services(discovery, app)
+            output = surok.apps.jinja2.Template(
+                "{{ services['zzy0.sub'][0]['tcp']['tname_aa'] }} "
+                "{{ services.hosts[0]['tcp']['tname_aa'] }} "
+                "{{ services.used[0]['tcp']['tname_aa'] }}").render(services=services)
+            with self.subTest(msg="Testing services with nested Marathon names and helper names..."):
+                self.assertEqual(output, '31000 31001 31002')
+                self.assertEqual(sorted(services), ['hosts', 'used', 'zzy0.sub'])
+                self.assertEqual(sorted(services), sorted(discovery.resolve(app)))
+        finally:
+            marathon._tasks, marathon._ports = tasks, ports
+            config.clear()
+
+    def test10_Apps_render_failure(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        tmp = tempfile.mkdtemp()
+        confd = os.path.join(tmp, 'conf.d')
+        os.mkdir(confd)
+        render_app = surok.apps._render_app
+        def failing_render_app(job):
+            if job[0] == 'app0':
+                raise RuntimeError('render failed')
+            return render_app(job)
+        try:
+            for i in range(3):
+                with open(os.path.join(confd, 'app{}.json'.format(i)), 'w') as f:
+                    json.dump({'conf_name': 'app{}'.format(i), 'services': [],
+                               'files': {os.path.join(tmp, 'app{}.out'.format(i)): '{{ my["conf_name"] }}'}}, f)
+            config.set_config({'confd': confd, 'force_render': 0, 'templates': {'workers': 2}})
+            surok.apps._render_app = failing_render_app
+            apps = surok.apps.Apps()
+            apps.update()
+            executor = apps._executor
+            apps.update()
+            with self.subTest(msg="Testing failed render does not stop other renders and executor..."):
+                self.assertFalse(os.path.exists(os.path.join(tmp, 'app0.out')))
+                for i in (1, 2):
+                    with open(os.path.join(tmp, 'app{}.out'.format(i))) as f:
+                        self.assertEqual(f.read(), 'app{}'.format(i))
+                self.assertIsNotNone(executor)
+                self.assertIs(apps._executor, executor)
+        finally:
+            surok.apps._render_app = render_app
+            Logger().reset()
+            config.set_config({'templates': {'workers': 1}})
+            config.clear()
+            shutil.rmtree(tmp)
+
+class Test06_Templates(unittest.TestCase):
+    def test01_Templates_cache(self):
+        config = Config()
+        config['templates']['cache_size'] = 2
+        templates = surok.templates.Templates()
+        source = 'Test {{ my.name }}'
+        template = templates.get(source)
+        with self.subTest(msg="Testing compiled template cache..."):
+            self.assertIs(templates.get(source), template)
+            self.assertEqual(templates.render(source, my={'name': 'template'}), 'Test template')
+        templates.get('Test 1')
+        templates.get('Test 2')
+        with self.subTest(msg="Testing compiled template cache eviction..."):
+            self.assertIsNot(templates.get(source), template)
+        config['templates']['cache_dir'] = '/tmp'
+        templates.get('Test bytecode cache')
+        with self.subTest(msg="Testing templates bytecode cache..."):
+            self.assertTrue([x for x in os.listdir('/tmp') if x.startswith('__jinja2_')])
+        config.clear()
+
+class Test07_Watcher(unittest.TestCase):
+    def test01_Watcher(self):
+        config = Config()
+        path = tempfile.mkdtemp()
+        watcher = surok.watcher.Watcher()
+        watched_file = os.path.join(path, 'watched')
+        open(watched_file, 'w').close()
+        watcher.watch([watched_file])
+        watcher.changes()
+        open(os.path.join(path, 'not_watched'), 'w').close()
+        f = open(watched_file, 'w')
+        f.write('changed')
+        f.close()
+        changes = set()
+        wait_for(lambda: changes.update(watcher.changes()) or watched_file in changes)
+        with self.subTest(msg="Testing watcher changes...", changes=changes):
+            self.assertEqual(changes, {watched_file})
+        watcher.watch([path])
+        watcher._stats = watcher._poll_stats()
+        open(os.path.join(path, 'new'), 'w').close()
+        with self.subTest(msg="Testing watcher polling changes..."):
+            self.assertEqual(watcher._read_poll(), {os.path.join(path, 'new')})
+        shutil.rmtree(path)
+        watcher.watch([])
+        config.clear()
+
+class Test08_Writer(unittest.TestCase):
+    def test01_Writer(self):
+        config = Config()
+        writer = surok.writer.Writer()
+        path = tempfile.mkdtemp()
+        try:
+            dest = os.path.join(path, 'test.conf')
+            with self.subTest(msg="Testing write of new file..."):
+                self.assertTrue(writer.write(dest, 'data 1'))
+                with open(dest) as f:
+                    self.assertEqual(f.read(), 'data 1')
+            os.chmod(dest, 0o640)
+            inode = os.stat(dest).st_ino
+            with self.subTest(msg="Testing unchanged file is not written..."):
+                self.assertFalse(writer.write(dest, 'data 1'))
+                self.assertEqual(os.stat(dest).st_ino, inode)
+            with self.subTest(msg="Testing atomic replace of changed file..."):
+                self.assertTrue(writer.write(dest, 'data 2'))
+                self.assertNotEqual(os.stat(dest).st_ino, inode)
+                self.assertEqual(os.stat(dest).st_mode & 0o777, 0o640)
+                self.assertEqual(sorted(os.listdir(path)), ['test.conf'])
+            with open(dest, 'w') as f:
+                f.write('changed on disk')
+            with self.subTest(msg="Testing file changed on disk is written..."):
+                self.assertTrue(writer.write(dest, 'data 2'))
+            link = os.path.join(path, 'link.conf')
+            os.symlink(dest, link)
+            with self.subTest(msg="Testing write over symlink..."):
+                self.assertTrue(writer.write(link, 'data 3'))
+                self.assertTrue(os.path.islink(link))
+                with open(dest) as f:
+                    self.assertEqual(f.read(), 'data 3')
+            config['batch_fsync'] = True
+            with self.subTest(msg="Testing batched directory sync..."):
+                self.assertTrue(writer.write(dest, 'data 4'))
+                self.assertEqual(writer._dirs, set([path]))
+                writer.sync()
+                self.assertEqual(writer._dirs, set())
+        finally:
+            config['batch_fsync'] = False
+            shutil.rmtree(path)
+
+class Test09_Reloader(unittest.TestCase):
+    def test01_Reloader(self):
+        config = Config()
+        reloader = surok.reloader.Reloader()
+        path = tempfile.mkdtemp()
+        try:
+            out = os.path.join(path, 'out')
+            cmd = 'echo reload >> ' + out
+            start = time.time()
+            for i in range(3):
+                reloader.reload('test_debounce', cmd, debounce=1)
+            with self.subTest(msg="Testing reload does not block..."):
+                self.assertLess(time.time() - start, 0.5)
+                self.assertFalse(os.path.isfile(out))
+            self.assertTrue(reloader.join(10))
+            result = reloader.results()['test_debounce']
+            with self.subTest(msg="Testing debounced reloads are merged...", result=result):
+                with open(out) as f:
+                    self.assertEqual(f.read(), 'reload\n')
+                self.assertEqual(result['returncode'], 0)
+                self.assertGreaterEqual(result['time'] - start, 1)
+            config['reload_timeout'] = 1
+            start = time.time()
+            reloader.reload('test_timeout', 'echo started; sleep 10', debounce=0)
+            reloader.reload('test_exit', 'exit 3', debounce=0)
+            self.assertTrue(reloader.join(10))
+            results = reloader.results()
+            with self.subTest(msg="Testing reload timeout and exit code...", results=results):
+                self.assertLess(time.time() - start, 5)
+                self.assertNotEqual(results['test_timeout']['returncode'], 0)
+                self.assertEqual(results['test_timeout']['output'], 'started\n')
+                self.assertEqual(results['test_exit']['returncode'], 3)
+        finally:
+            config['reload_timeout'] = 60
+            shutil.rmtree(path)
+
+class Test10_Metrics(unittest.TestCase):
+    def test01_Metrics_render(self):
+        metrics = surok.metrics.Metrics()
+        metrics.inc('surok_test_total', {'backend': 'test'})
+        metrics.inc('surok_test_total', {'backend': 'test'}, 2)
+        metrics.observe('surok_test_seconds', 0.02)
+        metrics.observe('surok_test_seconds', 100)
+        output = metrics.render()
+        with self.subTest(msg="Testing Prometheus text format...", output=output):
+            self.assertIn('# TYPE surok_test_total counter\nsurok_test_total{backend="test"} 3\n', output)
+            self.assertIn('surok_test_seconds_bucket{le="0.01"} 0\n', output)
+            self.assertIn('surok_test_seconds_bucket{le="0.05"} 1\n', output)
+            self.assertIn('surok_test_seconds_bucket{le="+Inf"} 2\n', output)
+            self.assertIn('surok_test_seconds_count 2\n', output)
+
+    def test02_Metrics_endpoint(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        confd = tempfile.mkdtemp()
+        with open(os.path.join(confd, 'metrics.json'), 'w') as f:
+            json.dump({'conf_name': 'metrics', 'services': [],
+                       'files': {os.path.join(confd, 'metrics.out'): '{{ my["conf_name"] }}'}}, f)
+        config.set_config({'confd': confd, 'force_render': 0, 'metrics_port': port})
+        try:
+            surok.apps.Apps().update()
+            output = urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(port), timeout=5).read().decode()
+            with self.subTest(msg="Testing metrics endpoint...", output=output):
+                self.assertIn('surok_cycle_seconds_count', output)
+                for phase in ('discovery', 'resolve', 'render', 'store'):
+                    self.assertIn('surok_phase_seconds_count{{phase="{}"}}'.format(phase), output)
+                self.assertIn('surok_changed_outputs ', output)
+        finally:
+            config['metrics_port'] = None
+            surok.metrics.Metrics().start()
+            config.clear()
+            shutil.rmtree(confd)
+
+
+class Test11_Profiler(unittest.TestCase):
+    def test01_Profiler_run(self):
+        config = Config('/usr/share/surok/conf/surok_check.json')
+        confd = tempfile.mkdtemp()
+        with open(os.path.join(confd, 'profile.json'), 'w') as f:
+            json.dump({'conf_name': 'profile', 'services': [],
+                       'files': {os.path.join(confd, 'profile.out'): '{{ my["conf_name"] }}'}}, f)
+        config.set_config({'confd': confd, 'force_render': 0})
+        try:
+            prefix = os.path.join(confd, 'profile')
+            report, trace = surok.profiler.Profiler(prefix).run(lambda: surok.apps.Apps().update(), 2)
+            with open(report) as f:
+                output = f.read()
+            with self.subTest(msg="Testing profile report...", output=output):
+                self.assertIn('cumulative', output)
+                self.assertIn('update', output)
+            with open(trace) as f:
+                events = json.load(f)['traceEvents']
+            names = set([x['name'] for x in events])
+            with self.subTest(msg="Testing profile trace...", names=names):
+                for name in ('surok_cycle_seconds', 'discovery', 'resolve', 'render', 'store'):
+                    self.assertIn(name, names)
+                self.assertEqual(len([x for x in events if x['name'] == 'surok_cycle_seconds']), 2)
+                self.assertIn({'phase': 'render', 'app': 'profile'}, [x['args'] for x in events])
+            with self.subTest(msg="Testing trace is stopped..."):
+                surok.metrics.Metrics().observe('surok_test_seconds', 0.01)
+                self.assertIsNone(surok.metrics.Metrics()._trace)
+        finally:
+            config.clear()
+            shutil.rmtree(confd)
+
 if __name__ == '__main__':
     unittest.main()
     sleep(1)
@@ -1,5 +1,9 @@
+import os
+
+
 def from_file(self, path):
     try:
+        self._files[path] = os.stat(path).st_mtime
         f = open(path, 'r')
         data = f.read()
         f.close()
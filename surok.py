@@ -1,19 +1,37 @@
 #!/usr/bin/python3
-from time import sleep
 import argparse
+import sys
 from surok.apps import Apps
 from surok.config import Config
+from surok.profiler import Profiler
+from surok.reloader import Reloader
 
 # Command line arguments
 parser = argparse.ArgumentParser()
 parser.add_argument('-c', '--config', help='surok.json path')
+parser.add_argument('-p', '--profile', type=int, metavar='CYCLES',
+                    help='run CYCLES forced update cycles under profiler and exit')
+parser.add_argument('--profile-output', default='surok-profile', metavar='PREFIX',
+                    help='prefix of profile report and trace files (default: surok-profile)')
 args = parser.parse_args()
 
 # Load base configurations
 config = Config(args.config if args.config else '/etc/surok/conf/surok.json')
 
-# Main loop
 apps = Apps()
+
+
+# Profile run, reloads are waited to get them into trace
+def profile_cycle():
+    apps.update(force_refresh=True)
+    Reloader().join(config.get('reload_timeout', 60))
+
+
+if args.profile:
+    Profiler(args.profile_output).run(profile_cycle, args.profile)
+    sys.exit(0)
+
+# Main loop
 while 1:
-    apps.update()
-    sleep(config['wait_time'])
+    apps.update(force_refresh=False)
+    apps.wait(config['wait_time'])
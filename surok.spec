@@ -28,6 +28,11 @@ install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/logger.py %{buildr
 install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/store.py %{buildroot}/opt/surok/surok
 install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/system.py %{buildroot}/opt/surok/surok
 install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/templates.py %{buildroot}/opt/surok/surok
+install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/watcher.py %{buildroot}/opt/surok/surok
+install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/writer.py %{buildroot}/opt/surok/surok
+install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/reloader.py %{buildroot}/opt/surok/surok
+install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/metrics.py %{buildroot}/opt/surok/surok
+install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/profiler.py %{buildroot}/opt/surok/surok
 install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok.py %{buildroot}/opt/surok
 mkdir -p %{buildroot}/etc/surok/{conf,conf.d,templates}
 install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/conf/surok.json %{buildroot}/etc/surok/conf
@@ -71,6 +76,24 @@ cd /opt/surok && pip3 install -r requriments.txt
 /opt/surok/surok/store.py
 /opt/surok/surok/store.pyc
 /opt/surok/surok/store.pyo
+/opt/surok/surok/templates.py
+/opt/surok/surok/templates.pyc
+/opt/surok/surok/templates.pyo
+/opt/surok/surok/watcher.py
+/opt/surok/surok/watcher.pyc
+/opt/surok/surok/watcher.pyo
+/opt/surok/surok/writer.py
+/opt/surok/surok/writer.pyc
+/opt/surok/surok/writer.pyo
+/opt/surok/surok/reloader.py
+/opt/surok/surok/reloader.pyc
+/opt/surok/surok/reloader.pyo
+/opt/surok/surok/metrics.py
+/opt/surok/surok/metrics.pyc
+/opt/surok/surok/metrics.pyo
+/opt/surok/surok/profiler.py
+/opt/surok/surok/profiler.pyc
+/opt/surok/surok/profiler.pyo
 /usr/share/surok/conf/surok_07.json
 /usr/share/surok/conf/surok_08.json
 /usr/share/surok/conf/surok_check.json
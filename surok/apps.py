@@ -1,12 +1,25 @@
+import collections.abc
+import concurrent.futures
+import concurrent.futures.process
 import jinja2
 import os
 import imp
-import requests
 import time
+import json
+import hashlib
+import multiprocessing
+import heapq
+import random
+import threading
 from .logger import Logger
 from .config import Config
-from .discovery import Discovery
-from .store import Store
+from .discovery import Discovery, MarathonClient
+from .store import Store, new_hash
+from .templates import Templates
+from .watcher import Watcher
+from .writer import Writer
+from .reloader import Reloader
+from .metrics import Metrics
 
 __all__ = ['Apps']
 
@@ -24,6 +37,10 @@ class Apps:
             'ENV1': 'Jinja2 template for value "{{ my.env.get('ENV1') }}"',
             'ENV2': 'Next Jinja2 template for value "{{ my.env.get('ENV2') }}"'
         }
+    .update(force_refresh=True) - update apps outputs
+    .wait(timeout) - wait for changes or next due app
+    .used_services() - dict of service names used by last render of every app
+    .lags() - dict of delays in seconds of last refresh of every app after its due time
     """
 
     def __init__(self):
@@ -31,76 +48,320 @@ class Apps:
         self._logger = Logger()
         self._store = Store()
         self._discovery = Discovery()
+        self._templates = Templates()
+        self._watcher = Watcher()
+        self._writer = Writer()
+        self._reloader = Reloader()
+        self._metrics = Metrics()
+        self._renders = {}
+        self._outputs = {}
+        self._dirty = set()
+        self._queue = []
+        self._due = {}
+        self._lags = {}
+        self._executor = None
+        self._executor_params = None
+        self._cycle = 0
+        self._refresh_time = 0
 
-    def update(self):
-        self._discovery.update_data()
+    # Update apps configurations
+    # If force_refresh is False, only due, changed and dirty apps and apps of discoveries
+    # with changed data are processed, discovery data is refreshed when discovery data is
+    # changed or "wait_time" or "refresh_interval" of due app is expired
+    def update(self, force_refresh=True):
+        self._metrics.start()
+        self._changed_outputs = 0
+        with self._metrics.timer('surok_cycle_seconds'):
+            self._update(force_refresh)
+        self._metrics.set('surok_changed_outputs', self._changed_outputs)
+        self._metrics.inc('surok_changed_outputs_total', value=self._changed_outputs)
+
+    def _update(self, force_refresh):
+        self._apply_changes(self._watcher.changes())
+        changed_discoveries = self._discovery.changes()
+        now = time.time()
+        due_apps = self._due_apps(now)
+        refresh_time = min([self._config['wait_time']] + [
+            self._config.apps[x].get('refresh_interval', self._config['wait_time'])
+            for x in due_apps if x in self._config.apps])
+        if force_refresh or changed_discoveries or now - self._refresh_time >= refresh_time:
+            self._refresh_time = now
+            with self._phase('discovery'):
+                self._discovery.update_data()
+        else:
+            self._config.update_apps()
         self._store.check()
+        if force_refresh:
+            due_apps = set(self._config.apps)
+        else:
+            due_apps.update(self._config.changed_apps)
+            due_apps.update(self._dirty)
+            # Apps of discoveries with changed data, unchanged inputs are skipped by fingerprint
+            due_apps.update([x for x in self._config.apps if self._config.apps[x]['services'] and
+                             self._config.apps[x]['discovery'] in changed_discoveries])
+            due_apps.update([x for x in self._config.apps if x not in self._due])
+        self._dirty = set()
+        removed_apps = [x for x in self._outputs if x not in self._config.apps]
+        if not [x for x in due_apps if x in self._config.apps] and not removed_apps:
+            return
+        with self._phase('store'):
+            self._store.prefetch(
+                [{'env': x, 'store': app['store']} for app in
+                 [self._config.apps[x] for x in due_apps if x in self._config.apps]
+                 for x in app['environments']] +
+                [{'dest': x, 'store': app['store']} for app in
+                 [self._config.apps[x] for x in due_apps if x in self._config.apps]
+                 for x in app['files']])
+        # Services used by previous render of due apps are resolved once, other on access
+        with self._phase('resolve'):
+            self._prefetch_services(due_apps)
+        force_render = self._force_render()
+        for job, result in self._map_renders(self._jobs(due_apps, now, force_render)):
+            self._apply_result(job, result)
+        self._discovery.clear()
+        for conf_name in removed_apps:
+            self._renders.pop(conf_name, None)
+            self._due.pop(conf_name, None)
+            self._lags.pop(conf_name, None)
+            self._metrics.unset('surok_app_lag_seconds', {'app': conf_name})
+            del self._outputs[conf_name]
+        with self._phase('write'):
+            self._writer.sync()
+        with self._phase('store'):
+            self._store.clear()
+        self._watcher.watch(
+            [self._config['confd'], self._config['modules']] +
+            [x for conf_name in self._renders for x in self._renders[conf_name]['files']])
+
+    def used_services(self):
+        return dict([(x, list(self._renders[x]['services'])) for x in self._renders])
+
+    def lags(self):
+        return dict(self._lags)
+
+    def _prefetch_services(self, due_apps):
+        apps = []
+        for conf_name in [x for x in due_apps if x in self._renders and x in self._config.apps]:
+            app = self._config.apps[conf_name]
+            used = self._renders[conf_name]['services']
+            apps.append({'discovery': app['discovery'],
+                         'group': app['group'],
+                         'services': [x for x in app['services'] if x['name'] in used]})
+        self._discovery.prefetch(apps)
+
+    # Wait for discovery data or watched files change, next due app, or timeout
+    def wait(self, timeout):
+        while self._queue and self._due.get(self._queue[0][1]) != self._queue[0][0]:
+            heapq.heappop(self._queue)
+        if self._queue:
+            timeout = max(0, min(timeout, self._queue[0][0] - time.time()))
+        return self._discovery.wait(timeout)
+
+    # Pop apps with expired refresh time from schedule queue
+    def _due_apps(self, now):
+        due_apps = set()
+        while self._queue and self._queue[0][0] <= now:
+            due, conf_name = heapq.heappop(self._queue)
+            if self._due.get(conf_name) == due:
+                due_apps.add(conf_name)
+        return due_apps
+
+    # Schedule next refresh of app after "refresh_interval" ("wait_time" by default)
+    # with random "refresh_jitter" delay. First refresh is after share of interval,
+    # apps scheduled in one cycle are spread across their intervals
+    def _schedule(self, conf_name, app, now, share=1):
+        interval = app.get('refresh_interval', self._config['wait_time'])
+        lag = now - self._due.get(conf_name, now)
+        self._lags[conf_name] = lag
+        self._metrics.set('surok_app_lag_seconds', lag, {'app': conf_name})
+        if lag > interval:
+            self._logger.warning('App "{0}" refresh is late for {1:.1f} seconds'.format(conf_name, lag))
+        due = now + interval * share + random.uniform(0, app.get('refresh_jitter', 0))
+        self._due[conf_name] = due
+        heapq.heappush(self._queue, (due, conf_name))
+
+    # Mark apps with changed template files as dirty, reload changed modules
+    def _apply_changes(self, changes):
+        if [x for x in changes if os.path.dirname(x) == os.path.abspath(self._config['modules'])]:
+            self._logger.info('Modules are changed. Reload modules')
+            LoadModules().reload()
+            self._shutdown_executor()
+            self._dirty.update(self._config.apps)
+            self._renders = {}
+        for conf_name in list(self._renders):
+            if [x for x in self._renders[conf_name]['files'] if os.path.abspath(x) in changes]:
+                self._dirty.add(conf_name)
+                del self._renders[conf_name]
+
+    # Generate render jobs of due apps, outputs of other apps are kept in store
+    def _jobs(self, due_apps, now, force_render):
+        new_apps = sorted([x for x in due_apps if x in self._config.apps and x not in self._due])
         for conf_name in sorted(self._config.apps):
+            if conf_name not in due_apps:
+                self._touch_outputs(conf_name)
+                continue
             app = self._config.apps[conf_name]
-            my = {"services": self._discovery.resolve(app),
-                  "conf_name": conf_name,
-                  "env": os.environ,
-                  "timestamp": time.time()}
-            _restart = False
-            self._error = False
-            for conf in [{
-                            'env': x[0],
-                            'value': self._render(my, x[1])
-                        } for x in app['environments'].items()]:
-                if self._store.check_update(conf):
-                    _restart = True
-                    os.environ[conf['env']] = conf['value']
-            for conf in [{
-                            'dest': x[0],
-                            'value': self._render(my, x[1])
-                        } for x in app['files'].items()]:
-                if self._store.check_update(conf):
-                    _restart = True
-                    self._logger.info("Write new configuration of ", conf.get('dest'))
-                    try:
-                        f = open(conf.get('dest'), 'w')
-                        f.write(conf.get('value'))
-                        f.close()
-                    except OSError as err:
-                        self._logger.error(
-                            'Config file {0} open or write error. OS error : {1}'.format(
-                                conf.get('dest'), err))
-                        pass
-                    except err:
-                        self._logger.error(
-                            'Config file {0} open or write error. Error : {1}'.format(
-                                conf.get('dest'), err))
-                        pass
-            if _restart and not self._error:
-                if self._config['marathon']['restart']:
-                    self._restart_self_in_marathon()
-                else:
-                    if app.get('reload_cmd'):
-                        self._logger.info('Restart "{0}" app:\n{1}'.format(
-                            app['reload_cmd'], os.popen(app['reload_cmd']).read()))
-        self._store.clear()
-
-    def _render(self, my, temp):
-        if type(temp).__name__ == 'str':
-            data = None
-            mod = LoadModules(_my=my)
+            if conf_name in new_apps:
+                self._schedule(conf_name, app, now, (new_apps.index(conf_name) + 1) / len(new_apps))
+            else:
+                self._schedule(conf_name, app, now)
+            services = _Services(self._discovery, app)
+            env = dict(os.environ)
+            # Only services used by previous render are resolved to check inputs
+            render = self._renders.get(conf_name)
+            if not force_render and render is not None:
+                try:
+                    with self._phase('resolve', conf_name):
+                        fingerprint = self._fingerprint(app, services._hosts_of(render['services']), env)
+                except Exception as err:
+                    # Failed services fail render of app, previous outputs are kept
+                    self._logger.error('Resolve services of app "{0}" failed. Error: {1}'.format(conf_name, err))
+                    fingerprint = None
+                if self._skip_render(conf_name, fingerprint):
+                    continue
+            yield (conf_name, dict(app['environments']), dict(app['files']), services, env)
+
+    # Render jobs, results are returned in jobs order
+    # Apps are rendered concurrently, if "workers" of "templates" section greater than 1
+    def _map_renders(self, jobs):
+        workers = self._config['templates'].get('workers', 1)
+        if workers <= 1:
+            for job in jobs:
+                yield job, _render_app(job)
+            return
+        executor = self._get_executor(workers, self._config['templates'].get('executor', 'thread'))
+        futures = [(job, executor.submit(_render_app, job)) for job in jobs]
+        for job, future in futures:
+            result = None
             try:
-                template = jinja2.Template(temp)
-                data = template.render(my=my, mod=mod)
-            except jinja2.UndefinedError as err:
-                self._logger.error('Render Jinja2 error. ', err)
-            except:
-                self._logger.error('Render Jinja2 error. Unknown error')
-            finally:
-                mod.dump_logs()
-                self._error = mod.get_error()
-            return data
+                result = future.result()
+            except concurrent.futures.process.BrokenProcessPool as err:
+                # Worker process is died, pool is created again on next cycle
+                self._logger.error('Render app "{0}" failed. Error: {1}'.format(job[0], err))
+                self._shutdown_executor()
+            except Exception as err:
+                # Failed render fails only its app, executor and other renders are kept
+                self._logger.error('Render app "{0}" failed. Error: {1}'.format(job[0], err))
+            yield job, result
+
+    def _get_executor(self, workers, executor):
+        if self._executor_params != (workers, executor):
+            self._shutdown_executor()
+            self._executor_params = (workers, executor)
+            if executor == 'process' and 'fork' not in multiprocessing.get_all_start_methods():
+                self._logger.error('Executor "process" requires fork of processes, threads are used')
+                executor = 'thread'
+            if executor == 'process':
+                self._executor = self._process_executor(workers)
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        return self._executor
+
+    # Workers are forked to get config, modules and compiled templates of main process
+    def _process_executor(self, workers):
+        try:
+            return concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                          mp_context=multiprocessing.get_context('fork'))
+        except TypeError:
+            # Python < 3.7, fork is default start method on POSIX
+            return concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+    def _shutdown_executor(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self._executor = None
+        self._executor_params = None
+
+    # Update store, environment and files with app render result, run reload command
+    def _apply_result(self, job, result):
+        conf_name, services, env = job[0], job[3], job[4]
+        if result is None:
+            self._metrics.inc('surok_failures_total', {'backend': 'render'})
+            self._renders.pop(conf_name, None)
+            self._touch_outputs(conf_name)
+            return
+        self._metrics.observe('surok_phase_seconds', result['duration'], {'phase': 'render'},
+                              start=result['start'], args={'app': conf_name})
+        if result['error']:
+            self._metrics.inc('surok_failures_total', {'backend': 'render'})
+        app = self._config.apps[conf_name]
+        _restart = False
+        for conf in result['envs'] + result['files']:
+            conf['store'] = app['store']
+        for conf in result['envs']:
+            with self._phase('store', conf_name):
+                changed = self._store.check_update(conf)
+            if changed:
+                _restart = True
+                self._changed_outputs += 1
+                os.environ[conf['env']] = conf['value']
+        self._outputs[conf_name] = [{'env': x['env'], 'store': x['store']} for x in result['envs']] + [
+            {'dest': x['dest'], 'store': x['store']} for x in result['files']]
+        if result['error']:
+            self._renders.pop(conf_name, None)
+        else:
+            self._logger.debug('App "{0}" used services: {1}'.format(conf_name, result['services']))
+            self._renders[conf_name] = {
+                'fingerprint': self._fingerprint(app, services._hosts_of(result['services']), env),
+                'services': result['services'],
+                'files': result['read_files']}
+        # Files are compared with current content on disk, unchanged files are not written
+        for conf in result['files']:
+            with self._phase('store', conf_name):
+                self._store.check_update(conf)
+            if conf['value'] is None:
+                continue
+            with self._phase('write', conf_name):
+                written = self._writer.write(conf['dest'], conf['value'], conf['hash'])
+            if written:
+                _restart = True
+                self._changed_outputs += 1
+                self._logger.info("Write new configuration of ", conf.get('dest'))
+        if _restart and not result['error']:
+            if self._config['marathon']['restart']:
+                self._restart_self_in_marathon()
+            else:
+                if app.get('reload_cmd'):
+                    self._reloader.reload(conf_name, app['reload_cmd'], app.get('reload_debounce'))
+
+    def _phase(self, phase, conf_name=None):
+        return self._metrics.timer('surok_phase_seconds', {'phase': phase},
+                                   None if conf_name is None else {'app': conf_name})
+
+    def _touch_outputs(self, conf_name):
+        for conf in self._outputs.get(conf_name, []):
+            self._store.touch(conf)
+
+    # Full render of all apps every "force_render" cycles
+    def _force_render(self):
+        self._cycle += 1
+        cycles = self._config.get('force_render', 10)
+        return cycles <= 0 or self._cycle % cycles == 0
+
+    # Fingerprint of app render inputs: app config, discovery data and environment
+    def _fingerprint(self, app, services, env):
+        return hashlib.sha1(json.dumps(
+            [app.hash(), services, sorted(env.items())], sort_keys=True).encode()).hexdigest()
+
+    # Skip render if app inputs and files read through modules are not changed
+    def _skip_render(self, conf_name, fingerprint):
+        render = self._renders.get(conf_name)
+        if render is None or render['fingerprint'] != fingerprint:
+            return False
+        for path in render['files']:
+            try:
+                if os.stat(path).st_mtime != render['files'][path]:
+                    return False
+            except OSError:
+                return False
+        self._touch_outputs(conf_name)
+        return True
 
     def _restart_self_in_marathon(self):
         env = os.environ.get('MARATHON_APP_ID')
         if env:
-            r = requests.post('http://' + self._config['marathon']['host'] + '/v2/apps/' + env + '/restart',
-                              data={'force': self._config['marathon']['force']})
+            r = MarathonClient().post('/v2/apps/' + env + '/restart',
+                                      data={'force': self._config['marathon']['force']})
             if r.status_code != 200:
                 self._logger.error('Restart container {0} failed. {1}'.format(
                     env, r.raise_for_status()))
@@ -108,41 +369,207 @@ class Apps:
             self._logger.error('Restart self container failed. Cannot find MARATHON_APP_ID.')
 
 
+# Render environments and files of app job in worker thread or process
+# Return dict:
+# {'envs': [{'env': 'ENV1', 'value': 'value', 'hash': 'hash'}],
+#  'files': [{'dest': '/path', 'value': 'data', 'hash': 'hash'}],
+#  'error': False, 'read_files': {'/path/template.jj2': mtime}, 'services': ['service1'],
+#  'start': 1500000000.0, 'duration': 0.01}
+def _render_app(job):
+    start = time.time()
+    conf_name, environments, files, services, env = job
+    result = {'envs': [], 'files': [], 'error': False, 'read_files': {}}
+    my = {"services": services,
+          "conf_name": conf_name,
+          "env": env,
+          "timestamp": time.time()}
+    modules = LoadModules()
+    for key, temp in environments.items():
+        context = modules.context(my, result['read_files'])
+        value, digest = _render(context, temp)
+        result['envs'].append({'env': key, 'value': value, 'hash': digest})
+        result['error'] = result['error'] or context.get_error()
+    env.update([(x['env'], x['value']) for x in result['envs'] if x['value'] is not None])
+    for dest, temp in files.items():
+        context = modules.context(my, result['read_files'])
+        value, digest = _render(context, temp)
+        result['files'].append({'dest': dest, 'value': value, 'hash': digest})
+        result['error'] = result['error'] or context.get_error()
+    if None in [x['value'] for x in result['envs'] + result['files']]:
+        result['error'] = True
+    result['services'] = services._used_names()
+    result['start'] = start
+    result['duration'] = time.time() - start
+    return result
+
+
+# Render template, hash of result is computed while rendering
+# Return tuple (data, hash), or (None, None) if render failed
+def _render(context, temp):
+    data = None
+    digest = None
+    if type(temp).__name__ == 'str':
+        try:
+            content_hash = new_hash()
+            chunks = []
+            for chunk in context._templates.get(temp).generate(my=context._my, mod=context):
+                content_hash.update(chunk.encode())
+                chunks.append(chunk)
+            data = ''.join(chunks)
+            digest = content_hash.hexdigest()
+        except jinja2.UndefinedError as err:
+            context._logger.error('Render Jinja2 error. {}'.format(err))
+        except:
+            context._logger.error('Render Jinja2 error. Unknown error')
+        finally:
+            context.dump_logs()
+    return data, digest
+
+
+class _Services(collections.abc.Mapping):
+    """ Hosts of app services in templates, my['services']
+    ==================================================
+    Service is resolved on first access and kept for render. Hosts are keyed
+    by service name, by "name.group" for Marathon name "group/name", or by app
+    name for Marathon masks "name*". Services resolved for template are recorded
+    as used. In worker process all services are resolved before render. Helpers
+    are private, any service name is available to templates as attribute.
+    ._hosts_of(names=None) - dict of hosts of services with names, of all services if None
+    ._used_names() - names of services used by template
+    """
+
+    def __init__(self, discovery, app):
+        self._discovery = discovery
+        self._app = app
+        self._services = list(app['services'])
+        self._resolved = {}
+        self._used = set()
+        self._lock = threading.Lock()
+
+    def _resolve(self, index, use=True):
+        with self._lock:
+            if index not in self._resolved:
+                self._resolved[index] = self._discovery.resolve_service(self._app, self._services[index])
+            if use:
+                self._used.add(index)
+            return self._resolved[index]
+
+    # Later services override hosts of earlier services, as in Discovery.resolve
+    # Marathon name "group/name" is keyed by "name.group", as apps of Marathon masks
+    def __getitem__(self, key):
+        for index in reversed(range(len(self._services))):
+            name = self._services[index]['name']
+            if key in [name, '.'.join(name.split('/')[::-1])] or name.endswith('*'):
+                hosts = self._resolve(index)
+                if key in hosts:
+                    return hosts[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._hosts(None, True))
+
+    def __len__(self):
+        return len(self._hosts(None, True))
+
+    def keys(self):
+        return self._hosts(None, True).keys()
+
+    def items(self):
+        return self._hosts(None, True).items()
+
+    def values(self):
+        return self._hosts(None, True).values()
+
+    def _hosts_of(self, names=None):
+        return self._hosts(names, False)
+
+    def _hosts(self, names, use):
+        hosts = {}
+        for index in range(len(self._services)):
+            if names is None or self._services[index]['name'] in names:
+                hosts.update(self._resolve(index, use))
+        return hosts
+
+    def _used_names(self):
+        names = []
+        for index in sorted(self._used):
+            if self._services[index]['name'] not in names:
+                names.append(self._services[index]['name'])
+        return names
+
+    # Services are resolved before pickling to worker process
+    def __getstate__(self):
+        self._hosts_of()
+        with self._lock:
+            state = self.__dict__.copy()
+        del state['_lock']
+        state['_discovery'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
 class LoadModules:
+    """ Public LoadModules object
+    ==================================================
+    Functions of modules from "modules" directory.
+    .reload() - load modules again
+    .context(my, files) - get render context with modules functions, "mod" in templates
+    """
     _instance = None
-    _get_module = True
-    _orig = {}
-    _logs = []
 
     def __new__(cls, **pars):
         if cls._instance is None:
             cls._instance = super(LoadModules, cls).__new__(cls)
         return cls._instance
 
-    def __init__(self, **pars):
-        for key in pars:
-            if pars[key] is None:
-                if hasattr(LoadModules, key):
-                    delattr(LoadModules, key)
-            else:
-                setattr(LoadModules, key, pars[key])
-        self._logerror = False
-        if self._get_module:
+    def __init__(self):
+        if not hasattr(self, '_functions'):
             self._config = Config()
             self._logger = Logger()
-            mpath = self._config['modules']
-            for module in [os.path.join(mpath, f) for f in os.listdir(
-                    mpath) if os.path.isfile(os.path.join(mpath, f))]:
-                try:
-                    m = imp.load_source('__surok.module__', module)
-                except:
-                    self._logger.error('Load module {} failed.'.format(module))
-                finally:
-                    for key in [x for x in dir(m) if type(
-                            getattr(m, x)).__name__ == 'function' and not x.startswith('_')]:
-                        self._orig[key] = _ExecModule(self, key, getattr(m, key))
-                        setattr(LoadModules, key, self._orig[key].execute)
-            self._get_module = False
+            self._templates = Templates()
+            self.reload()
+
+    def reload(self):
+        functions = {}
+        mpath = self._config['modules']
+        for module in [os.path.join(mpath, f) for f in os.listdir(
+                mpath) if os.path.isfile(os.path.join(mpath, f))]:
+            m = None
+            try:
+                m = imp.load_source('__surok.module__', module)
+            except:
+                self._logger.error('Load module {} failed.'.format(module))
+            finally:
+                for key in [x for x in dir(m) if type(
+                        getattr(m, x)).__name__ == 'function' and not x.startswith('_')]:
+                    functions[key] = getattr(m, key)
+        self._functions = functions
+
+    def context(self, my, files):
+        return _RenderContext(self, my, files)
+
+
+class _RenderContext:
+
+    def __init__(self, modules, my, files):
+        self._modules = modules
+        self._config = modules._config
+        self._logger = modules._logger
+        self._templates = modules._templates
+        self._my = my
+        self._files = files
+        self._logs = []
+        self._logerror = False
+
+    # Modules functions are attributes of context
+    def __getattr__(self, name):
+        function = self._modules._functions.get(name)
+        if function is None:
+            raise AttributeError(name)
+        return _ExecModule(self, name, function).execute
 
     def _error(self):
         self._logerror = True
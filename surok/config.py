@@ -1,6 +1,7 @@
 import hashlib
 import json
 import os
+import stat
 from .logger import Logger
 
 __all__ = ['Config', 'AppConfig']
@@ -192,11 +193,15 @@ class Config(_ConfigTemplate):
              conf_data(dict type) - dict with config
     .set(key,value) - set config key
     .get(key) - get config key
-    .update_apps() - update apps config data
+    .update_apps() - update apps config data, return set of changed app names
     .apps - Dict of AppConfig oblects
+    .changed_apps - Set of app names changed by last .update_apps()
     """
     _instance = None
     apps = {}
+    changed_apps = set()
+    _apps_files = {}
+    _apps_conf_hash = None
     _params = {
         'marathon': {
             'params': {
@@ -215,6 +220,18 @@ class Config(_ConfigTemplate):
                 'restart': {
                     'value': False,
                     'type': ['bool']
+                },
+                'events': {
+                    'type': ['bool']
+                },
+                'connect_timeout': {
+                    'type': ['int']
+                },
+                'read_timeout': {
+                    'type': ['int']
+                },
+                'events_timeout': {
+                    'type': ['int']
                 }
             },
             'type': ['dict']
@@ -228,6 +245,47 @@ class Config(_ConfigTemplate):
                 'enabled': {
                     'value': False,
                     'type': ['bool']
+                },
+                'workers': {
+                    'type': ['int']
+                }
+            },
+            'type': ['dict']
+        },
+        'dns': {
+            'params': {
+                'cache': {
+                    'value': True,
+                    'type': ['bool']
+                },
+                'cache_size': {
+                    'value': 1024,
+                    'type': ['int']
+                },
+                'nameservers': {
+                    'type': ['list', 'str']
+                },
+                'port': {
+                    'type': ['int']
+                }
+            },
+            'type': ['dict']
+        },
+        'templates': {
+            'params': {
+                'cache_size': {
+                    'value': 256,
+                    'type': ['int']
+                },
+                'cache_dir': {
+                    'type': ['str', 'dir']
+                },
+                'workers': {
+                    'type': ['int']
+                },
+                'executor': {
+                    'type': ['str', 'value'],
+                    'values': ['thread', 'process']
                 }
             },
             'type': ['dict']
@@ -245,6 +303,19 @@ class Config(_ConfigTemplate):
             },
             'type': ['dict']
         },
+        'sqlite': {
+            'params': {
+                'path': {
+                    'value': '/var/tmp/surok.sqlite',
+                    'type': ['str']
+                },
+                'enabled': {
+                    'value': False,
+                    'type': ['bool']
+                }
+            },
+            'type': ['dict']
+        },
         'memcached': {
             'params': {
                 'enabled': {
@@ -271,6 +342,9 @@ class Config(_ConfigTemplate):
                 },
                 'hosts': {
                     'type': ['list', 'str']
+                },
+                'namespace': {
+                    'type': ['str']
                 }
             },
             'type': ['dict']
@@ -292,6 +366,34 @@ class Config(_ConfigTemplate):
             'value': 20,
             'type': ['int']
         },
+        'force_render': {
+            'type': ['int']
+        },
+        'watch': {
+            'type': ['bool']
+        },
+        'batch_fsync': {
+            'type': ['bool']
+        },
+        'metrics_port': {
+            'type': ['int']
+        },
+        'gc_full_sweep': {
+            'type': ['int']
+        },
+        'hash_algorithm': {
+            'type': ['str', 'value'],
+            'values': ['md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512', 'blake2b', 'blake2s']
+        },
+        'reload_timeout': {
+            'type': ['int']
+        },
+        'reload_workers': {
+            'type': ['int']
+        },
+        'reload_debounce': {
+            'type': ['int']
+        },
         'lock_dir': {
             'type': ['str', 'dir']
         },
@@ -308,7 +410,7 @@ class Config(_ConfigTemplate):
         'default_store': {
             'value': 'memory',
             'type': ['str', 'value'],
-            'values': ['memory', 'files', 'memcached']
+            'values': ['memory', 'files', 'memcached', 'sqlite']
         },
         'domain': {
             'type': ['str']
@@ -342,12 +444,39 @@ class Config(_ConfigTemplate):
                 return True
         return False
 
+    # Reload only new and changed app config files
+    # Return set of changed, added and removed app names
     def update_apps(self):
-        self.apps = {}
-        for app_conf in [x for x in [os.path.join(
-                self['confd'], x) for x in os.listdir(self['confd'])] if os.path.isfile(x)]:
-            app = AppConfig(app_conf)
-            self.apps[app['conf_name']] = app
+        env = os.environ
+        conf_hash = (self.hash(), env.get('SUROK_DISCOVERY_GROUP'), env.get('MARATHON_APP_ID'))
+        if conf_hash != self._apps_conf_hash:
+            self._apps_files = {}
+            self._apps_conf_hash = conf_hash
+        apps_files = {}
+        changed = set()
+        for app_conf in [os.path.join(self['confd'], x) for x in os.listdir(self['confd'])]:
+            try:
+                st = os.stat(app_conf)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            file_stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+            old = self._apps_files.get(app_conf)
+            if old is not None and old[0] == file_stat:
+                apps_files[app_conf] = old
+            else:
+                app = AppConfig(app_conf)
+                apps_files[app_conf] = (file_stat, app)
+                changed.add(app['conf_name'])
+                if old is not None:
+                    changed.add(old[1]['conf_name'])
+        for app_conf in [x for x in self._apps_files if x not in apps_files]:
+            changed.add(self._apps_files[app_conf][1]['conf_name'])
+        self._apps_files = apps_files
+        self.apps = dict([(x[1]['conf_name'], x[1]) for x in apps_files.values()])
+        self.changed_apps = changed
+        return changed
 
 
 class AppConfig(_ConfigTemplate):
@@ -399,13 +528,22 @@ class AppConfig(_ConfigTemplate):
         'reload_cmd': {
             'type': ['str']
         },
+        'refresh_interval': {
+            'type': ['int']
+        },
+        'refresh_jitter': {
+            'type': ['int']
+        },
+        'reload_debounce': {
+            'type': ['int']
+        },
         'discovery': {
             'type': ['str', 'value'],
             'values': ['none', 'mesos_dns', 'marathon_api']
         },
         'store': {
             'type': ['str', 'value'],
-            'values': ['memory', 'files', 'memcached']
+            'values': ['memory', 'files', 'memcached', 'sqlite']
         },
         'group': {
             'type': ['str']
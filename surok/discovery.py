@@ -2,33 +2,259 @@ import dns.resolver
 import dns.query
 import requests
 import dns.exception
+import concurrent.futures
+import collections
+import bisect
+import threading
+import time
+import json
+import hashlib
 from .config import Config
 from .logger import Logger
+from .metrics import Metrics
 
-__all__ = ['Discovery', 'DiscoveryMesos', 'DiscoveryMarathon']
+__all__ = ['Discovery', 'DiscoveryMesos', 'DiscoveryMarathon', 'DNSCache', 'MarathonClient']
+
+
+class MarathonClient:
+    """ Public MarathonClient object
+    ==================================================
+    Shared HTTP session for Marathon API with keep-alive connections,
+    gzip compression and connect/read timeouts.
+    .get(path, params) - GET request. Return JSON data, or None if data is
+        not changed since previous request (ETag, Last-Modified or content hash)
+    .post(path, data) - POST request. Return response object
+    .stream(path, headers) - GET streaming request, stream without data for
+        "events_timeout" seconds is failed
+    .invalidate() - forget previous responses, next .get returns data
+    """
+    _instance = None
+    _connect_timeout = 5
+    _read_timeout = 30
+    _events_timeout = 60
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(MarathonClient, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, '_session'):
+            self._config = Config()
+            self._session = requests.Session()
+            self._session.headers['Accept-Encoding'] = 'gzip'
+            self._responses = {}
+
+    def _url(self, path):
+        return self._config['marathon']['host'] + path
+
+    def _timeout(self, stream=False):
+        conf = self._config['marathon']
+        return (conf.get('connect_timeout', self._connect_timeout),
+                conf.get('events_timeout', self._events_timeout) if stream else
+                conf.get('read_timeout', self._read_timeout))
+
+    def get(self, path, params=None):
+        headers = {}
+        key = (path, json.dumps(params, sort_keys=True))
+        old = self._responses.get(key, {})
+        if old.get('etag'):
+            headers['If-None-Match'] = old['etag']
+        if old.get('last_modified'):
+            headers['If-Modified-Since'] = old['last_modified']
+        r = self._request('GET', path, params=params, headers=headers)
+        if r.status_code == 304:
+            return None
+        r.raise_for_status()
+        new = {'etag': r.headers.get('ETag'),
+               'last_modified': r.headers.get('Last-Modified'),
+               'hash': hashlib.sha1(r.content).hexdigest()}
+        self._responses[key] = new
+        if old.get('hash') == new['hash']:
+            return None
+        return r.json()
+
+    def post(self, path, data=None):
+        return self._request('POST', path, data=data)
+
+    # Request with metrics of count, latency and failures
+    def _request(self, method, path, **kwargs):
+        metrics = Metrics()
+        start = time.time()
+        try:
+            r = self._session.request(method, self._url(path), timeout=self._timeout(), **kwargs)
+        except requests.RequestException:
+            metrics.inc('surok_marathon_requests_total', {'method': method, 'code': 'error'})
+            metrics.inc('surok_failures_total', {'backend': 'marathon'})
+            raise
+        finally:
+            metrics.observe('surok_marathon_request_seconds', time.time() - start, {'method': method},
+                            start=start, args={'path': path})
+        metrics.inc('surok_marathon_requests_total', {'method': method, 'code': str(r.status_code)})
+        if r.status_code >= 400:
+            metrics.inc('surok_failures_total', {'backend': 'marathon'})
+        return r
+
+    def stream(self, path, headers=None):
+        return self._session.get(self._url(path), stream=True, headers=headers,
+                                 timeout=self._timeout(stream=True))
+
+    def invalidate(self):
+        self._responses = {}
+
+
+class DNSCache:
+    """ Public DNSCache object
+    ==================================================
+    Answers cache shared by all discoveries. Answers live until TTL
+    expiration, least recently used answers are evicted when cache
+    holds more than "cache_size" answers.
+    .get(fqdn, rdtype) - get cached answer, None if not cached
+    .set(fqdn, rdtype, data, expiration) - cache answer until expiration time
+    .stats() - dict with hits, misses, evictions and entries counters
+    .clear() - drop all answers and counters
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(DNSCache, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, '_records'):
+            self._config = Config()
+            self._lock = threading.Lock()
+            self.clear()
+
+    def enabled(self):
+        return self._config['dns']['cache']
+
+    def get(self, fqdn, rdtype):
+        if not self.enabled():
+            return None
+        key = (fqdn.lower(), rdtype)
+        with self._lock:
+            record = self._records.get(key)
+            if record is not None and record[0] <= time.time():
+                del self._records[key]
+                record = None
+            if record is None:
+                self._misses += 1
+                return None
+            self._records.move_to_end(key)
+            self._hits += 1
+            return list(record[1])
+
+    def set(self, fqdn, rdtype, data, expiration):
+        if not self.enabled() or expiration <= time.time():
+            return
+        with self._lock:
+            key = (fqdn.lower(), rdtype)
+            self._records[key] = (expiration, list(data))
+            self._records.move_to_end(key)
+            while len(self._records) > max(self._config['dns']['cache_size'], 0):
+                self._records.popitem(last=False)
+                self._evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self._hits,
+                    'misses': self._misses,
+                    'evictions': self._evictions,
+                    'entries': len(self._records)}
+
+    def clear(self):
+        with self._lock:
+            self._records = collections.OrderedDict()
+            self._hits = 0
+            self._misses = 0
+            self._evictions = 0
 
 
 class DiscoveryTemplate:
+    _executor = None
+    _executor_workers = 0
+    _changed = threading.Event()
+    _changed_sections = set()
+    _changed_lock = threading.Lock()
 
     def __init__(self):
         self._config = Config()
         self._logger = Logger()
+        self._dns_cache = DNSCache()
 
     def enabled(self):
         return self._config[self._config_section].get('enabled', False)
 
+    # Record change of discovery data and wake up waiting main loop
+    def _notify(self):
+        with DiscoveryTemplate._changed_lock:
+            DiscoveryTemplate._changed_sections.add(self._config_section)
+        DiscoveryTemplate._changed.set()
+
+    # Apply func to every item of items
+    # Items are processed concurrently, if "workers" of config section greater than 1
+    # Return list of results in items order
+    def _map(self, func, items):
+        workers = self._config[self._config_section].get('workers', 1)
+        if workers > 1 and len(items) > 1:
+            if self._executor_workers != workers:
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+                self._executor_workers = workers
+            return list(self._executor.map(func, items))
+        return [func(x) for x in items]
+
     def update_data(self):
         pass
 
+    # Resolve every service separately
+    # Return list of hosts dicts in services order
+    def resolve_units(self, services):
+        return [self.resolve({'group': x['group'], 'services': [x]}) for x in services]
+
+    # DNS query with metrics of count, latency and failures
+    def _query(self, resolver, fqdn, rdtype):
+        metrics = Metrics()
+        start = time.time()
+        try:
+            query = resolver.query(fqdn, rdtype)
+        except dns.exception.DNSException:
+            metrics.inc('surok_dns_requests_total', {'type': rdtype, 'result': 'error'})
+            metrics.inc('surok_failures_total', {'backend': 'dns'})
+            raise
+        finally:
+            metrics.observe('surok_dns_request_seconds', time.time() - start, {'type': rdtype},
+                            start=start, args={'fqdn': fqdn})
+        metrics.inc('surok_dns_requests_total', {'type': rdtype, 'result': 'ok'})
+        return query
+
+    # Resolver with servers of /etc/resolv.conf, or "nameservers" and "port" of "dns" section
+    def _resolver(self):
+        resolver = dns.resolver.Resolver()
+        conf = self._config['dns']
+        if conf.get('nameservers'):
+            resolver.nameservers = conf['nameservers']
+        if conf.get('port'):
+            resolver.port = conf['port']
+        return resolver
+
     # Do DNS queries
     # Return array:
     # ["10.10.10.1", "10.10.10.2"]
     def do_query_a(self, fqdn):
+        servers = self._dns_cache.get(fqdn, 'A')
+        if servers is not None:
+            return servers
         servers = []
         try:
-            resolver = dns.resolver.Resolver()
-            for a_rdata in resolver.query(fqdn, 'A'):
+            resolver = self._resolver()
+            query = self._query(resolver, fqdn, 'A')
+            for a_rdata in query:
                 servers.append(a_rdata.address)
+            self._dns_cache.set(fqdn, 'A', servers, query.expiration)
         except dns.exception.DNSException as err:
             self._logger.error('Could not resolve {0}. Error: {1}'.format(fqdn, err))
         return servers
@@ -37,23 +263,44 @@ class DiscoveryTemplate:
     # Return array:
     # [{"name": "f.q.d.n", "port": 8876, "ip": ["10.10.10.1", "10.10.10.2"]}]
     def do_query_srv(self, fqdn):
+        servers = self._dns_cache.get(fqdn, 'SRV')
+        if servers is not None:
+            return servers
         servers = []
         try:
-            resolver = dns.resolver.Resolver()
+            resolver = self._resolver()
             resolver.lifetime = 1
             resolver.timeout = 1
-            query = resolver.query(fqdn, 'SRV')
+            query = self._query(resolver, fqdn, 'SRV')
             for rdata in query:
                 info = str(rdata).split()
                 servers.append({'name': info[3][:-1], 'port': info[2]})
+            self._dns_cache.set(fqdn, 'SRV', servers, query.expiration)
         except dns.exception.DNSException as err:
             self._logger.error('Could not resolve {0}. Error: {1}'.format(fqdn, err))
         return servers
 
 
 class Discovery:
+    """ Public Discovery object
+    ==================================================
+    Services are resolved by units of one protocol and port. Units shared
+    by apps of cycle are resolved once, "compatible" is applied once per
+    unique service. Units are resolved without lock, concurrent resolves
+    wait only for units resolved by other threads.
+    .resolve(app) - hosts of app services, own dict of every app
+    .resolve_service(app, service) - hosts of one service of app
+    .prefetch(apps) - resolve unique units of apps once for cycle
+    .clear() - forget resolved units and services of cycle
+    .update_data() - update apps configs and discovery data
+    .wait(timeout), .notify(data=True) - wait for and signal discovery data change
+    .changes() - names of discoveries with data changed since previous call
+    """
     _instance = None
     _discoveries = {}
+    _units = None
+    _services = None
+    _lock = threading.Lock()
 
     def __new__(cls):
         if cls._instance is None:
@@ -74,22 +321,180 @@ class Discovery:
         return self._discoveries.keys()
 
     def resolve(self, app):
+        discovery = self._discovery(app)
+        if discovery is None:
+            return {}
+        return self._resolve_app(discovery, app, app['services'])
+
+    def resolve_service(self, app, service):
+        discovery = self._discovery(app)
+        if discovery is None:
+            return {}
+        return self._resolve_app(discovery, app, [service])
+
+    # Return discovery name of app, or None if app has no services or discovery is not available
+    def _discovery(self, app):
         if app['services']:
             discovery = app.get('discovery', self._config['default_discovery'])
             if discovery in self.keys():
                 if self._discoveries[discovery].enabled():
-                    return self.compatible(self._discoveries[discovery].resolve(app))
+                    return discovery
                 else:
                     self._logger.error('Discovery "{}" is disabled'.format(discovery))
             else:
                 self._logger.warning('Discovery "{}" is not present'.format(discovery))
-        return {}
+        return None
+
+    def prefetch(self, apps):
+        units = {}
+        reserved = {}
+        for app in [x for x in apps if x['services']]:
+            discovery = app.get('discovery', self._config['default_discovery'])
+            if discovery in self.keys() and self._discoveries[discovery].enabled():
+                for service in app['services']:
+                    reserved.setdefault(discovery, {}).update(
+                        self._reserve(units, self._service_units(discovery, app, service)[1]))
+        with self._lock:
+            self._units = units
+            self._services = {}
+        # Failed units are failed for cycle, services using them fail on resolve
+        for discovery in reserved:
+            try:
+                self._resolve_reserved(discovery, units, reserved[discovery])
+            except Exception as err:
+                self._logger.error('Prefetch of "{0}" discovery failed. Error: {1}'.format(discovery, err))
+
+    def clear(self):
+        with self._lock:
+            self._units = None
+            self._services = None
+
+    # Hosts of app services from units and services resolved in cycle
+    # Units not resolved yet are resolved in one batch. Apps may be resolved from
+    # render threads: units are reserved under lock and resolved without it, readers
+    # of units resolved by other thread wait for these units only
+    def _resolve_app(self, discovery, app, app_services):
+        # Services of "none" discovery have no hosts, apps may have no group
+        if isinstance(self._discoveries[discovery], DiscoveryNone):
+            return {}
+        keys = []
+        with self._lock:
+            units = self._units if self._units is not None else {}
+            services = self._services if self._services is not None else {}
+            reserved = {}
+            for service in app_services:
+                service_key, service_units = self._service_units(discovery, app, service)
+                if service_key is None:
+                    self._logger.error(
+                        'Group for service "{}" of config "{}" not found'.format(
+                            service['name'], app.get('conf_name')))
+                    continue
+                keys.append((service_key, service_units))
+                reserved.update(self._reserve(units, service_units))
+        if reserved:
+            self._resolve_reserved(discovery, units, reserved)
+        hosts = {}
+        for service_key, service_units in keys:
+            with self._lock:
+                service_hosts = services.get(service_key)
+            if service_hosts is None:
+                service_hosts = {}
+                for unit_key in service_units:
+                    self._merge(service_hosts, units[unit_key].result())
+                service_hosts = self.compatible(service_hosts)
+                with self._lock:
+                    service_hosts = services.setdefault(service_key, service_hosts)
+            hosts.update(service_hosts)
+        return hosts
+
+    # Add futures of units not resolved or reserved yet to units
+    # Return dict of reserved units by key, caller resolves them
+    def _reserve(self, units, service_units):
+        reserved = {}
+        for unit_key, unit in service_units.items():
+            if unit_key not in units:
+                units[unit_key] = concurrent.futures.Future()
+                reserved[unit_key] = unit
+        return reserved
+
+    # Resolve reserved units in one batch, results or error are set to their futures
+    def _resolve_reserved(self, discovery, units, reserved):
+        try:
+            results = self._resolve_units(discovery, reserved)
+        except Exception as err:
+            for unit_key in reserved:
+                units[unit_key].set_exception(err)
+            raise
+        for unit_key in reserved:
+            units[unit_key].set_result(results[unit_key])
+
+    # Return dict of units by key (discovery, group, name, protocol, port)
+    def _resolve_units(self, discovery, units):
+        keys = list(units)
+        return dict(zip(keys, self._discoveries[discovery].resolve_units([units[x] for x in keys])))
+
+    # Split service to units of one protocol and port, "tcp": [] is unit of all ports
+    # Return tuple (service key, OrderedDict of units by key), or (None, {}) if group is not found
+    def _service_units(self, discovery, app, service):
+        group = service.get('group', app.get('group'))
+        if group is None:
+            return None, collections.OrderedDict()
+        name = service['name']
+        service_key = (discovery, group, name,
+                       tuple(service['tcp']) if 'tcp' in service else None,
+                       tuple(service['udp']) if 'udp' in service else None)
+        units = collections.OrderedDict()
+        for prot in [x for x in ['tcp', 'udp'] if x in service]:
+            for port in service[prot] or [None]:
+                units[(discovery, group, name, prot, port)] = {
+                    'name': name, 'group': group, prot: [] if port is None else [port]}
+        if not units:
+            units[(discovery, group, name, None, None)] = {'name': name, 'group': group}
+        return service_key, units
+
+    # Merge hosts of unit into hosts of service, unit hosts are not changed
+    def _merge(self, hosts, unit_hosts):
+        for name in unit_hosts:
+            merged = hosts.setdefault(name, [])
+            index = dict([(x['name'], x) for x in merged])
+            for unit_host in unit_hosts[name]:
+                host = index.get(unit_host['name'])
+                if host is None:
+                    host = index[unit_host['name']] = {'name': unit_host['name'], 'ip': list(unit_host['ip'])}
+                    merged.append(host)
+                for prot in [x for x in unit_host if x not in ['name', 'ip']]:
+                    if type(unit_host[prot]).__name__ == 'list':
+                        host.setdefault(prot, []).extend(unit_host[prot])
+                    else:
+                        host.setdefault(prot, {}).update(unit_host[prot])
 
     def update_data(self):
         self._config.update_apps()
         for d in self.keys():
             if self._discoveries[d].enabled():
                 self._discoveries[d].update_data()
+        self._logger.debug('DNS cache: ', DNSCache().stats())
+
+    # Wake up waiting main loop, data of all discoveries is changed if data is True
+    def notify(self, data=True):
+        if data:
+            for d in self.keys():
+                self._discoveries[d]._notify()
+        DiscoveryTemplate._changed.set()
+
+    # Return names of discoveries with data changed since previous call
+    def changes(self):
+        with DiscoveryTemplate._changed_lock:
+            sections = DiscoveryTemplate._changed_sections
+            DiscoveryTemplate._changed_sections = set()
+        return set([x for x in self.keys() if self._discoveries[x]._config_section in sections])
+
+    # Wait for discovery data or watched files change, or timeout
+    # Return True if data was changed
+    def wait(self, timeout):
+        changed = DiscoveryTemplate._changed.wait(timeout)
+        DiscoveryTemplate._changed.clear()
+        return changed
 
     def compatible(self, hosts):
         compatible_hosts = {}
@@ -118,9 +523,29 @@ class Discovery:
 class DiscoveryMesos(DiscoveryTemplate):
     _config_section = 'mesos'
 
+    # Services are resolved in batches with concurrent queries. Hosts are
+    # keyed by service name, so services of batch have different names
+    def resolve_units(self, services):
+        batches = []
+        for i, service in enumerate(services):
+            for batch in batches:
+                if service['name'] not in batch:
+                    batch[service['name']] = i
+                    break
+            else:
+                batches.append({service['name']: i})
+        results = [None] * len(services)
+        for batch in batches:
+            hosts = self.resolve({'group': None, 'services': [services[x] for x in batch.values()]})
+            for name, i in batch.items():
+                results[i] = {name: hosts.get(name, [])}
+        return results
+
     def resolve(self, app):
         hosts = {}
         domain = self._config['mesos']['domain']
+        services = []
+        queries = []
         for service in app['services']:
             group = service.get('group', app['group'])
             if group is None:
@@ -129,28 +554,36 @@ class DiscoveryMesos(DiscoveryTemplate):
                         service['name'], app.get('conf_name')))
                 continue
             name = service['name']
-            hosts[name] = {}
-            serv = hosts[name]
+            services.append((name, {}))
+            serv = services[-1][1]
             for prot in [x for x in ['tcp', 'udp'] if x in service]:
                 ports = service[prot]
                 if len(ports):
                     for port_name in ports:
-                        for hostname, port in [(x['name'], x['port']) for x in self.do_query_srv(
-                                '_{0}._{1}.{2}._{3}.{4}'.format(
-                                    port_name, name, group, prot, domain))]:
-                            if hostname not in serv:
-                                serv[hostname] = {'name': hostname,
-                                                  'ip': self.do_query_a(hostname)}
-                            serv[hostname].setdefault(prot, {})
-                            serv[hostname][prot][port_name] = port
+                        queries.append((serv, prot, port_name, '_{0}._{1}.{2}._{3}.{4}'.format(
+                            port_name, name, group, prot, domain)))
                 else:
-                    for hostname, port in [(x['name'], x['port']) for x in self.do_query_srv(
-                            '_{0}.{1}._{2}.{3}'.format(name, group, prot, domain))]:
-                        if hostname not in serv:
-                            serv[hostname] = {'name': hostname,
-                                              'ip': self.do_query_a(hostname)}
-                        serv[hostname].setdefault(prot, [])
-                        serv[hostname][prot].append(port)
+                    queries.append((serv, prot, None, '_{0}.{1}._{2}.{3}'.format(
+                        name, group, prot, domain)))
+        # SRV queries first, then A queries for every unique target host
+        srv_data = self._map(self.do_query_srv, [x[3] for x in queries])
+        hostnames = []
+        for hostname in [x['name'] for servers in srv_data for x in servers]:
+            if hostname not in hostnames:
+                hostnames.append(hostname)
+        a_data = dict(zip(hostnames, self._map(self.do_query_a, hostnames)))
+        for (serv, prot, port_name, fqdn), servers in zip(queries, srv_data):
+            for hostname, port in [(x['name'], x['port']) for x in servers]:
+                if hostname not in serv:
+                    serv[hostname] = {'name': hostname,
+                                      'ip': list(a_data[hostname])}
+                if port_name is None:
+                    serv[hostname].setdefault(prot, [])
+                    serv[hostname][prot].append(port)
+                else:
+                    serv[hostname].setdefault(prot, {})
+                    serv[hostname][prot][port_name] = port
+        for name, serv in services:
             hosts[name] = list(serv.values())
         return hosts
 
@@ -159,32 +592,188 @@ class DiscoveryMarathon(DiscoveryTemplate):
     _config_section = 'marathon'
     _tasks = []
     _ports = {}
+    _index = (None, {}, [])
+
+    _terminal_states = ['TASK_FINISHED', 'TASK_FAILED', 'TASK_KILLED', 'TASK_LOST',
+                        'TASK_ERROR', 'TASK_DROPPED', 'TASK_GONE', 'TASK_GONE_BY_OPERATOR']
+    _events_thread = None
+    _events_connected = False
+    _events_retry = 5
+    _embedded = False
 
     def update_data(self):
-        hostname = self._config[self._config_section].get('host')
+        if self._config[self._config_section].get('events'):
+            self._start_events()
+            # Tasks and ports are updated from events stream
+            if self._events_connected:
+                return
+        self._pull_data()
+
+    def _pull_data(self):
+        client = MarathonClient()
         try:
-            ports = {}
-            for app in requests.get(hostname + '/v2/apps').json()['apps']:
-                ports[app['id']] = {}
-                if app.get('container') is not None and app['container'].get('type') == 'DOCKER':
-                    ports[app['id']] = app['container']['docker'].get('portMappings', [])
-            self._ports = ports
+            apps = client.get('/v2/apps', {'embed': 'apps.tasks'})
+            if apps is not None:
+                ports = {}
+                tasks = []
+                for app in apps['apps']:
+                    ports[app['id']] = self._app_ports(app)
+                    tasks.extend(app.get('tasks', []))
+                self._ports = ports
+                # Old Marathon versions do not embed tasks to apps
+                self._embedded = all(['tasks' in x for x in apps['apps']])
+                if self._embedded and tasks != self._tasks:
+                    self._tasks = tasks
         except:
+            client.invalidate()
             self._logger.warning(
-                'Apps ({}/v2/apps) request from Marathon API is failed'.format(hostname))
+                'Apps ({}/v2/apps) request from Marathon API is failed'.format(
+                    self._config[self._config_section].get('host')))
             pass
+        if not self._embedded:
+            try:
+                tasks = client.get('/v2/tasks')
+                if tasks is not None and tasks['tasks'] != self._tasks:
+                    self._tasks = tasks['tasks']
+            except:
+                client.invalidate()
+                self._logger.warning(
+                    'Tasks ({}/v2/tasks) request from Marathon API is failed'.format(
+                        self._config[self._config_section].get('host')))
+                pass
+
+    def _app_ports(self, app):
+        if app.get('container') is not None and app['container'].get('type') == 'DOCKER':
+            return app['container']['docker'].get('portMappings', [])
+        return {}
+
+    def _start_events(self):
+        if self._events_thread is None or not self._events_thread.is_alive():
+            self._events_thread = threading.Thread(target=self._events_loop,
+                                                   name='surok-marathon-events')
+            self._events_thread.daemon = True
+            self._events_thread.start()
+
+    # Subscribe to Marathon events stream
+    # Full resync of apps and tasks is made on every (re)connect only. Stream without
+    # data for "events_timeout" seconds is reconnected, half-open connection is not kept
+    def _events_loop(self):
+        while self._config[self._config_section].get('events'):
+            hostname = self._config[self._config_section].get('host')
+            response = None
+            try:
+                response = MarathonClient().stream('/v2/events',
+                                                   headers={'Accept': 'text/event-stream'})
+                response.raise_for_status()
+                MarathonClient().invalidate()
+                self._pull_data()
+                self._events_connected = True
+                self._notify()
+                self._read_events(response)
+            except:
+                self._logger.warning(
+                    'Events ({}/v2/events) stream from Marathon API is failed'.format(hostname))
+                pass
+            finally:
+                self._events_connected = False
+                if response is not None:
+                    response.close()
+            if self._config[self._config_section].get('events'):
+                time.sleep(self._events_retry)
+
+    # Parse server-sent events
+    def _read_events(self, response):
+        response.encoding = 'utf-8'
+        event, data = None, []
+        for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+            if not self._config[self._config_section].get('events'):
+                break
+            if not line:
+                if data:
+                    self._apply_event(event, '\n'.join(data))
+                event, data = None, []
+            elif not line.startswith(':'):
+                field, value = (line.split(':', 1) + [''])[:2]
+                if value.startswith(' '):
+                    value = value[1:]
+                if field == 'event':
+                    event = value
+                elif field == 'data':
+                    data.append(value)
+
+    def _apply_event(self, event, data):
         try:
-            self._tasks = requests.get(hostname + '/v2/tasks').json()['tasks']
-        except:
-            self._logger.warning(
-                'Tasks ({}/v2/tasks) request from Marathon API is failed'.format(hostname))
-            pass
+            data = json.loads(data)
+        except ValueError as err:
+            self._logger.warning('Marathon event "{0}" JSON format error: {1}'.format(event, err))
+            return
+        event = data.get('eventType', event)
+        self._logger.debug('Marathon event: ', event)
+        if event == 'status_update_event':
+            self._apply_status_update(data)
+        elif event in ['deployment_info', 'deployment_success', 'deployment_step_success']:
+            self._apply_apps(data.get('plan', {}).get('target', {}).get('apps', []))
+        elif event == 'api_post_event' and data.get('appDefinition'):
+            self._apply_apps([data['appDefinition']])
+        else:
+            return
+        self._notify()
+
+    def _apply_status_update(self, data):
+        task_id = data.get('taskId')
+        tasks = [x for x in self._tasks if x.get('id') != task_id]
+        if data.get('taskStatus') not in self._terminal_states:
+            app_id = data.get('appId')
+            service_ports = [x['servicePorts'] for x in self._find_tasks(app_id)][:1]
+            if not service_ports:
+                service_ports = [[x.get('servicePort') for x in self._ports.get(app_id, [])]]
+            tasks.append({'id': task_id,
+                          'appId': app_id,
+                          'host': data.get('host'),
+                          'ports': data.get('ports', []),
+                          'servicePorts': service_ports[0]})
+        self._tasks = tasks
+
+    def _apply_apps(self, apps):
+        ports = self._ports.copy()
+        for app in apps:
+            ports[app['id']] = self._app_ports(app)
+        self._ports = ports
 
     def _test_mask(self, mask, value):
         return (mask.endswith('*') and value.startswith(mask[:-1])) or mask == value
 
+    # Index tasks by appId. Return tuple (tasks, index by appId, sorted appIds)
+    # Rebuilt only when the task list is changed, tuple is replaced at once,
+    # so readers in render threads never see index of other task list
+    def _get_index(self):
+        index = self._index
+        tasks = self._tasks
+        if index[0] is not tasks:
+            apps = {}
+            for task in tasks:
+                apps.setdefault(task['appId'], []).append(task)
+            index = (tasks, apps, sorted(apps))
+            self._index = index
+        return index
+
+    # Return tasks with appId matched to mask
+    # "/group/name" - exact appId, "/group/na*" - appId prefix
+    def _find_tasks(self, mask):
+        index, keys = self._get_index()[1:]
+        if not mask.endswith('*'):
+            return index.get(mask, [])
+        prefix = mask[:-1]
+        tasks = []
+        i = bisect.bisect_left(keys, prefix)
+        while i < len(keys) and keys[i].startswith(prefix):
+            tasks.extend(index[keys[i]])
+            i += 1
+        return tasks
+
     def resolve(self, app):
         hosts = {}
+        services = {}
         for service in app['services']:
             group = service.get('group', app.get('group'))
             if group is None:
@@ -195,33 +784,41 @@ class DiscoveryMarathon(DiscoveryTemplate):
             # Convert xxx.yyy.zzz to /zzz/yyy/xxx/ format
             group = '/' + '/'.join(group.split('.')[::-1]) + '/'
             service_mask = group + service['name']
-            for task in self._tasks:
-                if self._test_mask(service_mask, task['appId']):
-                    name = '.'.join(task['appId'][len(group):].split('/')[::-1])
-                    hosts[name] = {}
-                    serv = hosts[name]
-                    hostname = task['host']
-                    for task_port in self._ports[task['appId']]:
-                        prot = task_port['protocol']
-                        port_name = task_port['name']
-                        port = task['ports'][task['servicePorts'].index(task_port['servicePort'])]
-                        if prot in service:
-                            ports = service.get(prot, [])
-                            if len(ports):
-                                for port_mask in service.get(prot, []):
-                                    if self._test_mask(port_mask, port_name):
-                                        if hostname not in serv:
-                                            serv[hostname] = {'name': hostname,
-                                                              'ip': self.do_query_a(hostname)}
-                                        serv[hostname].setdefault(prot, {})
-                                        serv[hostname][prot][port_name] = port
-                            else:
-                                if hostname not in serv:
-                                    serv[hostname] = {'name': hostname,
-                                                      'ip': self.do_query_a(hostname)}
-                                serv[hostname].setdefault(prot, [])
-                                serv[hostname][prot].extend([port])
-                    hosts[name] = list(serv.values())
+            for task in self._find_tasks(service_mask):
+                name = '.'.join(task['appId'][len(group):].split('/')[::-1])
+                # Tasks of one app are merged, host of every task is kept
+                serv = services.setdefault(name, {})
+                hostname = task['host']
+                # App ports are replaced by deployment before its old tasks are stopped
+                try:
+                    task_ports = [(x, task['ports'][task['servicePorts'].index(x['servicePort'])])
+                                  for x in self._ports.get(task['appId'], [])]
+                except (ValueError, IndexError):
+                    self._logger.warning(
+                        'Ports of task "{0}" do not match ports of app "{1}", task is skipped'.format(
+                            task.get('id'), task['appId']))
+                    continue
+                for task_port, port in task_ports:
+                    prot = task_port['protocol']
+                    port_name = task_port['name']
+                    if prot in service:
+                        ports = service.get(prot, [])
+                        if len(ports):
+                            for port_mask in service.get(prot, []):
+                                if self._test_mask(port_mask, port_name):
+                                    if hostname not in serv:
+                                        serv[hostname] = {'name': hostname,
+                                                          'ip': self.do_query_a(hostname)}
+                                    serv[hostname].setdefault(prot, {})
+                                    serv[hostname][prot][port_name] = port
+                        else:
+                            if hostname not in serv:
+                                serv[hostname] = {'name': hostname,
+                                                  'ip': self.do_query_a(hostname)}
+                            serv[hostname].setdefault(prot, [])
+                            serv[hostname][prot].extend([port])
+        for name, serv in services.items():
+            hosts[name] = list(serv.values())
         return hosts
 
 
@@ -0,0 +1,203 @@
+import bisect
+import http.server
+import os
+import threading
+import time
+from .config import Config
+from .logger import Logger
+
+__all__ = ['Metrics']
+
+
+class _Timer:
+
+    def __init__(self, metrics, name, labels, args):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+        self._args = args
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self._metrics.observe(self._name, time.time() - self._start, self._labels,
+                              start=self._start, args=self._args)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = Metrics().render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class Metrics:
+    """ Public Metrics object
+    ==================================================
+    Counters and histograms in Prometheus text format. If "metrics_port"
+    is set, metrics are served on http://127.0.0.1:<metrics_port>/metrics
+    .inc(name, labels=None, value=1) - increase counter
+    .set(name, value, labels=None) - set gauge
+    .unset(name, labels=None) - remove gauge
+    .observe(name, value, labels=None, start=None, args=None) - add value to histogram
+    .timer(name, labels=None, args=None) - context manager, add duration of block to histogram
+    .render() - get metrics in Prometheus text format
+    .start() - start, restart or stop HTTP endpoint by config
+    .start_trace() - record every histogram value as trace event, with labels and args
+    .stop_trace() - stop recording, return list of trace events (Trace Event Format)
+    """
+    _instance = None
+    _buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+    _help = {
+        'surok_cycle_seconds': 'Duration of apps update cycle',
+        'surok_phase_seconds': 'Duration of cycle phases',
+        'surok_dns_requests_total': 'DNS requests',
+        'surok_dns_request_seconds': 'Latency of DNS requests',
+        'surok_marathon_requests_total': 'Marathon API requests',
+        'surok_marathon_request_seconds': 'Latency of Marathon API requests',
+        'surok_changed_outputs': 'Changed files and environments in last cycle',
+        'surok_changed_outputs_total': 'Changed files and environments',
+        'surok_app_lag_seconds': 'Delay of last app refresh after its due time',
+        'surok_failures_total': 'Failures by backend'
+    }
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(Metrics, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, '_lock'):
+            self._config = Config()
+            self._logger = Logger()
+            self._lock = threading.Lock()
+            self._counters = {}
+            self._gauges = {}
+            self._histograms = {}
+            self._server = None
+            self._port = None
+            self._trace = None
+
+    def _key(self, name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, value=1):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def unset(self, name, labels=None):
+        with self._lock:
+            self._gauges.pop(self._key(name, labels), None)
+
+    def observe(self, name, value, labels=None, start=None, args=None):
+        key = self._key(name, labels)
+        if self._trace is not None:
+            self._add_trace(name, value, labels, start, args)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(self._buckets), 'sum': 0, 'count': 0}
+            index = bisect.bisect_left(self._buckets, value)
+            if index < len(self._buckets):
+                histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def timer(self, name, labels=None, args=None):
+        return _Timer(self, name, labels, args)
+
+    def start_trace(self):
+        with self._lock:
+            self._trace = []
+
+    def stop_trace(self):
+        with self._lock:
+            trace = self._trace or []
+            self._trace = None
+        return trace
+
+    # Complete event of Trace Event Format, named by phase label or metric name
+    def _add_trace(self, name, value, labels, start, args):
+        if start is None:
+            start = time.time() - value
+        event_args = dict(labels or {})
+        event_args.update(args or {})
+        event = {'name': event_args.get('phase', name),
+                 'cat': name,
+                 'ph': 'X',
+                 'ts': int(start * 1000000),
+                 'dur': int(value * 1000000),
+                 'pid': os.getpid(),
+                 'tid': threading.current_thread().name,
+                 'args': event_args}
+        with self._lock:
+            if self._trace is not None:
+                self._trace.append(event)
+
+    def _format(self, name, labels, value):
+        if labels:
+            name += '{' + ','.join(['{0}="{1}"'.format(
+                x[0], str(x[1]).replace('\\', '\\\\').replace('"', '\\"')) for x in labels]) + '}'
+        return '{0} {1}'.format(name, repr(float(value)) if isinstance(value, float) else value)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = [(x, 'counter', self._counters) for x in self._counters] + \
+                      [(x, 'gauge', self._gauges) for x in self._gauges] + \
+                      [(x, 'histogram', self._histograms) for x in self._histograms]
+            described = set()
+            for (name, labels), kind, values in sorted(metrics, key=lambda x: x[0]):
+                if name not in described:
+                    lines.append('# HELP {0} {1}'.format(name, self._help.get(name, name)))
+                    lines.append('# TYPE {0} {1}'.format(name, kind))
+                    described.add(name)
+                value = values[(name, labels)]
+                if kind != 'histogram':
+                    lines.append(self._format(name, labels, value))
+                    continue
+                count = 0
+                for bound, bucket in zip(self._buckets, value['buckets']):
+                    count += bucket
+                    lines.append(self._format(name + '_bucket', labels + (('le', repr(float(bound))),), count))
+                lines.append(self._format(name + '_bucket', labels + (('le', '+Inf'),), value['count']))
+                lines.append(self._format(name + '_sum', labels, value['sum']))
+                lines.append(self._format(name + '_count', labels, value['count']))
+        return '\n'.join(lines) + '\n'
+
+    def start(self):
+        port = self._config.get('metrics_port')
+        if port == self._port:
+            return
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self._port = port
+        if port is None:
+            return
+        try:
+            self._server = http.server.HTTPServer(('127.0.0.1', port), _Handler)
+        except OSError as err:
+            self._logger.error('Start metrics endpoint on port {0} failed. OS error: {1}'.format(port, err))
+            return
+        thread = threading.Thread(target=self._server.serve_forever, name='surok-metrics')
+        thread.daemon = True
+        thread.start()
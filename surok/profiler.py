@@ -0,0 +1,44 @@
+import cProfile
+import json
+import pstats
+import time
+from .logger import Logger
+from .metrics import Metrics
+
+__all__ = ['Profiler']
+
+
+class Profiler:
+    """ Public Profiler object
+    ==================================================
+    Run cycles under cProfile and trace of cycle phases. Profile report sorted
+    by cumulative time is written to <prefix>.txt, trace of every cycle,
+    discovery request, render, store operation, write and reload is written
+    to <prefix>.trace.json in Trace Event Format (chrome://tracing, Perfetto).
+    .run(func, cycles) - call func cycles times, write report and trace
+    """
+
+    def __init__(self, prefix):
+        self._logger = Logger()
+        self._prefix = prefix
+
+    def run(self, func, cycles):
+        metrics = Metrics()
+        profile = cProfile.Profile()
+        metrics.start_trace()
+        try:
+            for cycle in range(cycles):
+                start = time.time()
+                profile.runcall(func)
+                self._logger.info('Profile cycle {0} of {1}: {2:.3f}s'.format(
+                    cycle + 1, cycles, time.time() - start))
+        finally:
+            trace = metrics.stop_trace()
+        report = self._prefix + '.txt'
+        with open(report, 'w') as f:
+            pstats.Stats(profile, stream=f).sort_stats('cumulative').print_stats()
+        trace_file = self._prefix + '.trace.json'
+        with open(trace_file, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+        self._logger.info('Profile report is written to {0}, trace to {1}'.format(report, trace_file))
+        return report, trace_file
@@ -0,0 +1,124 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+from .config import Config
+from .logger import Logger
+from .metrics import Metrics
+
+__all__ = ['Reloader']
+
+
+class Reloader:
+    """ Public Reloader object
+    ==================================================
+    Run apps reload commands in background. Reloads requested for app within
+    "reload_debounce" seconds are merged into one reload. At most
+    "reload_workers" commands are running at once, one per app, every command
+    is killed after "reload_timeout" seconds.
+    .reload(conf_name, cmd, debounce=None) - request reload of app
+    .join(timeout=None) - wait for all requested reloads, return False on timeout
+    .results() - dict of last reload results by app name:
+        {'cmd': 'command', 'returncode': 0, 'duration': 0.1, 'output': 'output', 'time': 1500000000.0}
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(Reloader, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, '_cond'):
+            self._config = Config()
+            self._logger = Logger()
+            self._cond = threading.Condition()
+            self._pending = {}
+            self._running = set()
+            self._results = {}
+            self._thread = None
+
+    def reload(self, conf_name, cmd, debounce=None):
+        if debounce is None:
+            debounce = self._config.get('reload_debounce', 0)
+        with self._cond:
+            pending = self._pending.get(conf_name)
+            if pending is None:
+                due = time.time() + debounce
+            else:
+                due = pending['due']
+                self._logger.debug('Reload of "{}" app is merged with pending reload'.format(conf_name))
+            # Command is run with environment of latest request
+            self._pending[conf_name] = {'cmd': cmd, 'env': dict(os.environ), 'due': due}
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='surok-reloader')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+
+    def join(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._running, timeout)
+
+    def results(self):
+        with self._cond:
+            return dict([(x, self._results[x].copy()) for x in self._results])
+
+    def _run(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                workers = self._config.get('reload_workers', 4)
+                waiting = sorted([(self._pending[x]['due'], x) for x in self._pending if x not in self._running])
+                if waiting and waiting[0][0] <= now and len(self._running) < workers:
+                    conf_name = waiting[0][1]
+                    self._running.add(conf_name)
+                    thread = threading.Thread(target=self._execute,
+                                              args=(conf_name, self._pending.pop(conf_name)),
+                                              name='surok-reload-' + conf_name)
+                    thread.daemon = True
+                    thread.start()
+                    continue
+                timeout = None
+                if waiting and len(self._running) < workers:
+                    timeout = waiting[0][0] - now
+                self._cond.wait(timeout)
+
+    def _execute(self, conf_name, reload):
+        start = time.time()
+        output = ''
+        returncode = None
+        try:
+            proc = subprocess.Popen(reload['cmd'], shell=True, env=reload['env'],
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    universal_newlines=True, start_new_session=True)
+            try:
+                output = proc.communicate(timeout=self._config.get('reload_timeout', 60))[0]
+            except subprocess.TimeoutExpired:
+                self._logger.error('Restart "{0}" app timed out. Kill command:\n{1}'.format(
+                    conf_name, reload['cmd']))
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                output = proc.communicate()[0]
+            returncode = proc.returncode
+        except OSError as err:
+            self._logger.error('Restart "{0}" app failed. OS error : {1}'.format(conf_name, err))
+        duration = time.time() - start
+        Metrics().observe('surok_phase_seconds', duration, {'phase': 'reload'},
+                          start=start, args={'app': conf_name})
+        self._logger.info('Restart "{0}" app:\n{1}'.format(reload['cmd'], output))
+        if returncode != 0:
+            Metrics().inc('surok_failures_total', {'backend': 'reload'})
+            self._logger.error('Restart "{0}" app failed. Exit code: {1}, duration: {2:.2f}s'.format(
+                conf_name, returncode, duration))
+        with self._cond:
+            self._results[conf_name] = {'cmd': reload['cmd'],
+                                        'returncode': returncode,
+                                        'duration': duration,
+                                        'output': output,
+                                        'time': start}
+            self._running.discard(conf_name)
+            self._cond.notify_all()
@@ -2,11 +2,13 @@ import os
 import hashlib
 import json
 import importlib
+import sqlite3
 from .logger import Logger
 from .config import Config, AppConfig
 from .discovery import Discovery
+from .metrics import Metrics
 
-__all__ = ['Store']
+__all__ = ['Store', 'new_hash']
 
 
 class Store(dict):
@@ -17,6 +19,10 @@ class Store(dict):
     _instance = None
     _stores = {}
     _update_store = {}
+    _cache = None
+    _pending = {}
+    _generation = 0
+    _live = {}
 
     def __new__(cls, *args):
         if cls._instance is None:
@@ -32,10 +38,16 @@ class Store(dict):
             self._stores['files'] = StoreFiles()
         if 'memcached' not in self._stores:
             self._stores['memcached'] = StoreMemcached(self)
+        if 'sqlite' not in self._stores:
+            self._stores['sqlite'] = StoreSqlite()
 
     def get(self, temp):
         new_temp = self._normalize(temp)
-        old_temp = self._stores[new_temp['store']].get(new_temp['hashid'], {})
+        key = (new_temp['store'], new_temp['hashid'])
+        if self._cache is not None and key in self._cache:
+            old_temp = (self._cache[key] or {}).copy()
+        else:
+            old_temp = self._stores[new_temp['store']].get(new_temp['hashid'], {})
         old_temp['store'] = new_temp['store']
         old_temp['hashid'] = new_temp['hashid']
         self._update_store[new_temp['hashid']] = new_temp['store']
@@ -44,26 +56,60 @@ class Store(dict):
     def set(self, temp):
         new_temp = self._normalize(temp)
         if new_temp.get('dest'):
-            self._stores[new_temp['store']].set(
-                new_temp.get('hashid'), {
-                    'hash': new_temp.get('hash'),
-                    'dest': new_temp.get('dest')})
+            record = {'hash': new_temp.get('hash'),
+                      'dest': new_temp.get('dest')}
         elif new_temp.get('env'):
-            self._stores[new_temp['store']].set(
-                new_temp.get('hashid'), {
-                    'hash': new_temp.get('hash'),
-                    'env': new_temp.get('env')})
+            record = {'hash': new_temp.get('hash'),
+                      'env': new_temp.get('env')}
+        else:
+            record = {'hash': new_temp.get('hash')}
+        if self._cache is not None:
+            self._cache[(new_temp['store'], new_temp['hashid'])] = record
+            self._pending.setdefault(new_temp['store'], {})[new_temp['hashid']] = record
         else:
-            self._stores[new_temp['store']].set(
-                new_temp.get('hashid'), {
-                    'hash': new_temp.get('hash')})
+            self._stores[new_temp['store']].set(new_temp.get('hashid'), record)
+        self._live.setdefault(new_temp['hashid'], (new_temp['store'], 0))
 
     def delete(self, temp):
         new_temp = self._normalize(temp)
         if self._update_store.get(new_temp['hashid']):
             del self._update_store[new_temp['hashid']]
+        self._live.pop(new_temp['hashid'], None)
+        if self._cache is not None:
+            self._cache[(new_temp['store'], new_temp['hashid'])] = None
+            self._pending.get(new_temp['store'], {}).pop(new_temp['hashid'], None)
         self._stores[new_temp['store']].delete(new_temp['hashid'])
 
+    # Mark record as used in current cycle without reading it
+    def touch(self, temp):
+        new_temp = self._normalize(temp)
+        self._update_store[new_temp['hashid']] = new_temp['store']
+
+    # Read records of cycle with one request per store. Until .flush(),
+    # records are read from cache and changes are kept in memory
+    def prefetch(self, temps):
+        if self._cache is None:
+            self._cache = {}
+            for store in self._stores.values():
+                if store.enabled():
+                    store.begin()
+        keys = {}
+        for temp in [self._normalize(x) for x in temps]:
+            if (temp['store'], temp['hashid']) not in self._cache:
+                keys.setdefault(temp['store'], []).append(temp['hashid'])
+        for store in keys:
+            records = self._stores[store].get_multi(keys[store])
+            for hashid in keys[store]:
+                self._cache[(store, hashid)] = records.get(hashid)
+
+    # Write changes of cycle with one request per store
+    def flush(self):
+        for store in self._pending:
+            if self._pending[store]:
+                self._stores[store].set_multi(self._pending[store])
+        self._pending = {}
+        self._cache = None
+
     def keys(self):
         keys = {}
         for key in self._stores.keys():
@@ -73,7 +119,7 @@ class Store(dict):
 
     def check_update(self, temp):
         new_temp = self._normalize(temp)
-        old_temp = self.get(new_temp.get('hashid'))
+        old_temp = self.get(new_temp)
         if new_temp.get('hash') is not None and old_temp.get('hash') != new_temp.get('hash'):
             self.set(new_temp)
             return True
@@ -83,39 +129,61 @@ class Store(dict):
         for key in self._stores:
             self._stores[key].check()
 
+    # Delete records not used in current cycle with their files and environments
+    # Every record keeps generation (cycle number) of its last use. Unused records
+    # are found from records used in previous cycles, all records of stores are
+    # scanned only every "gc_full_sweep" cycles
     def clear(self):
-        keys = self.keys()
-        for temp in [self.get(x) for x in keys if x not in self._update_store]:
-            temp['store'] = keys[temp['hashid']]
-            if temp.get('dest'):
-                try:
-                    if os.path.isfile(temp.get('dest')):
-                        os.remove(temp.get('dest'))
-                except OSError as err:
-                    self._logger.warning(
-                        "Delete file {0} failed:\n{1}".format(
-                            temp.get('dest'), err))
-                    pass
-            elif temp.get('env'):
-                try:
-                    if os.environ.get(temp.get('env')):
-                        del os.environ[temp.get('env')]
-                except:
-                    self._logger.warning(
-                        'Delete environment "{0}" failed.'.format(
-                            temp.get('env')))
-                    pass
-            self.delete(temp)
+        self.flush()
+        self._generation += 1
+        for hashid in self._update_store:
+            self._live[hashid] = (self._update_store[hashid], self._generation)
+        full_sweep = self._config.get('gc_full_sweep', 100)
+        if full_sweep <= 1 or self._generation % full_sweep == 1:
+            keys = self.keys()
+        else:
+            keys = dict([(x, self._live[x][0]) for x in self._live if self._live[x][1] < self._generation])
+        unused = {}
+        for hashid in [x for x in keys if x not in self._update_store]:
+            unused.setdefault(keys[hashid], []).append(hashid)
+            self._live.pop(hashid, None)
+        for store in unused:
+            records = self._stores[store].get_multi(unused[store])
+            for temp in [records[x] for x in unused[store] if records.get(x)]:
+                if temp.get('dest'):
+                    try:
+                        if os.path.isfile(temp.get('dest')):
+                            os.remove(temp.get('dest'))
+                    except OSError as err:
+                        self._logger.warning(
+                            "Delete file {0} failed:\n{1}".format(
+                                temp.get('dest'), err))
+                        pass
+                elif temp.get('env'):
+                    try:
+                        if os.environ.get(temp.get('env')):
+                            del os.environ[temp.get('env')]
+                    except:
+                        self._logger.warning(
+                            'Delete environment "{0}" failed.'.format(
+                                temp.get('env')))
+                        pass
+            self._stores[store].delete_multi(unused[store])
+        for store in self._stores.values():
+            store.commit()
         self._update_store = {}
 
+    # Normalize record once, normalized records are returned as is
     def _normalize(self, unnormconf):
         def hashsha1(data):
             return hashlib.sha1(data.encode()).hexdigest()
 
+        if isinstance(unnormconf, _Record):
+            return unnormconf
         if type(unnormconf).__name__ == 'dict':
-            conf = unnormconf.copy()
+            conf = _Record(unnormconf)
         else:
-            conf = {'hashid': unnormconf}
+            conf = _Record({'hashid': unnormconf})
         conf.setdefault('store', self._config['default_store'])
         if 'dest' in conf:
             conf['hashid'] = hashsha1(conf['dest'])
@@ -124,10 +192,11 @@ class Store(dict):
         elif 'localid' in conf:
             conf['hashid'] = hashsha1('data:' + conf['localid'])
 
+        # Hash of rendered value may be computed while rendering
         if 'data' in conf:
-            conf['hash'] = hashsha1(json.dumps(conf['data'], sort_keys=True))
-        elif type(conf.get('value')).__name__ == 'str':
-            conf['hash'] = hashsha1(conf['value'])
+            conf['hash'] = new_hash(json.dumps(conf['data'], sort_keys=True).encode()).hexdigest()
+        elif type(conf.get('value')).__name__ == 'str' and conf.get('hash') is None:
+            conf['hash'] = new_hash(conf['value'].encode()).hexdigest()
 
         if not self._stores[conf['store']].enabled():
             self._logger.warning(
@@ -137,6 +206,20 @@ class Store(dict):
         return conf
 
 
+class _Record(dict):
+    pass
+
+
+# New hash object of content hash function "hash_algorithm", sha1 by default
+def new_hash(data=b''):
+    name = Config().get('hash_algorithm', 'sha1')
+    try:
+        return hashlib.new(name, data)
+    except ValueError:
+        Logger().error('Hash algorithm "{}" is not available. Use sha1'.format(name))
+        return hashlib.sha1(data)
+
+
 class _StoreTemplate(dict):
 
     def __init__(self, *args):
@@ -161,11 +244,41 @@ class _StoreTemplate(dict):
     def enabled(self):
         return self._enabled
 
+    # Log error and count failure of store backend
+    def _error(self, *message):
+        Metrics().inc('surok_failures_total', {'backend': self._name})
+        self._logger.error(*message)
+
     def check(self):
         pass
 
+    # Start transaction of cycle changes
+    def begin(self):
+        pass
+
+    # Commit transaction of cycle changes
+    def commit(self):
+        pass
+
+    def get_multi(self, keys):
+        records = {}
+        for key in keys:
+            record = self.get(key)
+            if record is not None:
+                records[key] = record
+        return records
+
+    def set_multi(self, records):
+        for key in records:
+            self.set(key, records[key])
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.delete(key)
+
 
 class StoreMemory(_StoreTemplate):
+    _name = 'memory'
     _store = {}
     _enabled = True
 
@@ -183,72 +296,129 @@ class StoreMemory(_StoreTemplate):
 
 
 class StoreFiles(_StoreTemplate):
+    """ Records are kept in "<hashid>.surok" files and in memory index
+    ==================================================
+    Index is loaded from directory once and reloaded only if directory
+    mtime is changed by other process. Records are written through index.
+    """
+    _name = 'files'
     _enabled = False
+    _index = None
+    _index_path = None
+    _index_mtime = None
 
     def __init__(self, *args):
         super().__init__(*args)
         self.check()
 
-    def get(self, key, default=None):
-        temp = default
+    def _path(self, key):
+        return os.path.join(self._config['files']['path'], key + '.surok')
+
+    def _dir_mtime(self):
+        try:
+            return os.stat(self._config['files']['path']).st_mtime_ns
+        except OSError:
+            return None
+
+    # Reload index if directory or its mtime is changed
+    def _check_index(self):
+        path = self._config['files']['path']
+        mtime = self._dir_mtime()
+        if self._index is None or self._index_path != path or self._index_mtime != mtime:
+            index = {}
+            try:
+                names = os.listdir(path)
+            except OSError as err:
+                self._error(
+                    'Get keys from "files" store failed. OS error: {}'.format(err))
+                names = []
+            for name in [x for x in names if x.endswith('.surok')]:
+                temp = self._read(os.path.join(path, name))
+                if temp is not None:
+                    index[name[:-len('.surok')]] = temp
+            self._index = index
+            self._index_path = path
+            self._index_mtime = mtime
+        return self._index
+
+    def _read(self, filename):
+        temp = None
         try:
-            filename = os.path.join(self._config['files']['path'], key + '.surok')
             if os.path.isfile(filename):
                 f = open(filename, 'r')
                 json_temp = f.read()
                 f.close()
                 temp = json.loads(json_temp)
         except OSError as err:
-            self._logger.error(
+            self._error(
                 'Get from "files" store failed. OS error: {}'.format(err))
             pass
         except ValueError as err:
-            self._logger.error(
+            self._error(
                 'Get from "files" store failed. JSON format error: {}'.format(err))
             pass
         except:
-            self._logger.error('Get from "files" store failed. Unknown error.')
+            self._error('Get from "files" store failed. Unknown error.')
             pass
         return temp
 
+    def get(self, key, default=None):
+        if self._index is None:
+            self._check_index()
+        temp = self._index.get(key)
+        return default if temp is None else temp.copy()
+
     def set(self, key, value):
+        if self._index is None:
+            self._check_index()
+        tmp = self._path(key) + '.tmp'
         try:
-            f = open(os.path.join(self._config['files']['path'], key + '.surok'), 'w')
-            f.write(json.dumps(value, sort_keys=True))
+            data = json.dumps(value, sort_keys=True)
+            f = open(tmp, 'w')
+            f.write(data)
             f.close()
+            os.replace(tmp, self._path(key))
+            self._index[key] = json.loads(data)
+            self._index_mtime = self._dir_mtime()
         except OSError as err:
-            self._logger.error(
+            self._error(
                 'Set from "files" store failed. OS error: {0}'.format(err))
             pass
         except ValueError as err:
-            self._logger.error(
+            self._error(
                 'Set from "files" store failed. JSON format error: {0}'.format(err))
             pass
         except:
-            self._logger.error('Set from "files" store failed. Unknown error.')
+            self._error('Set from "files" store failed. Unknown error.')
             pass
 
     def keys(self):
-        return [f.split('.', 1)[0] for f in os.listdir(
-            self._config['files']['path']) if os.path.isfile(os.path.join(
-                self._config['files']['path'], f)) and f.split('.', 1)[1] == 'surok']
+        return list(self._check_index().keys())
 
     def delete(self, key):
+        if self._index is None:
+            self._check_index()
         try:
-            os.remove(os.path.join(self._config['files']['path'], key + '.surok'))
+            os.remove(self._path(key))
         except OSError as err:
-            self._logger.error(
+            self._error(
                 'Delete from "files" store failed. OS error: {0}'.format(err))
             pass
+        self._index.pop(key, None)
+        self._index_mtime = self._dir_mtime()
 
     def check(self):
         self._enabled = self._config['files']['enabled']
         if self._enabled and not os.path.isdir(self._config['files']['path']):
             self._enabled = False
+        if self._enabled:
+            self._check_index()
 
 
 class StoreMemcached(_StoreTemplate):
+    _name = 'memcached'
     _mc = None
+    _cas_retries = 10
     _enabled = False
     _hosts = []
     _mod_memcache = None
@@ -257,6 +427,10 @@ class StoreMemcached(_StoreTemplate):
         super().__init__(*args)
         self._enabled = self._config['memcached']['enabled']
         self._discovery = Discovery()
+        self._batch = False
+        self._manifest_add = set()
+        self._manifest_remove = set()
+        self._seeded = False
         if args and not hasattr(self, '_store'):
             self._store = args[0]
 
@@ -266,10 +440,10 @@ class StoreMemcached(_StoreTemplate):
                 if self._mod_memcache is None:
                     self._mod_memcache = importlib.import_module('memcache')
                 try:
-                    self._mc = self._mod_memcache.Client(self._hosts)
+                    self._mc = self._mod_memcache.Client(self._hosts, cache_cas=True)
                     self._enabled = True
                 except:
-                    self._logger.error('Create memcached object failed')
+                    self._error('Create memcached object failed')
                     self._disconnect()
             else:
                 try:
@@ -277,7 +451,7 @@ class StoreMemcached(_StoreTemplate):
                     self._mc.set_servers(self._hosts)
                     self._enabled = True
                 except:
-                    self._logger.error('Change memcached list of servers failed')
+                    self._error('Change memcached list of servers failed')
                     self._disconnect()
         else:
             self._disconnect()
@@ -328,14 +502,15 @@ class StoreMemcached(_StoreTemplate):
     def get(self, key, default=None):
         temp = default
         try:
-            if key in self.keys():
-                temp = json.loads(self._mc.get(key))
+            data = self._mc.get(key)
+            if data is not None:
+                temp = json.loads(data)
         except ValueError as err:
-            self._logger.error(
+            self._error(
                 'Get from "memcached" store failed. JSON format error: {0}'.format(err))
             pass
         except:
-            self._logger.error(
+            self._error(
                 'Get from "memcached" store failed. Unknown error. Made reconnect\nKey:', key)
             self.check()
             pass
@@ -344,33 +519,268 @@ class StoreMemcached(_StoreTemplate):
     def set(self, key, value):
         try:
             self._mc.set(key, json.dumps(value, sort_keys=True))
+            self._track(add=[key])
         except ValueError as err:
-            self._logger.error(
+            self._error(
                 'Set from "memcached" store failed. JSON format error: {0}'.format(err))
             pass
         except:
-            self._logger.error(
+            self._error(
                 ('Set from "memcached" store failed. Unknown error. Made reconnect\n'
                     'Key:'), key, '\nValue:\n', value)
             self.check()
             pass
 
+    def get_multi(self, keys):
+        records = {}
+        try:
+            data = self._mc.get_multi(keys)
+            for key in data:
+                records[key] = json.loads(data[key])
+            # Records written before manifest existed are added to manifest when used
+            self._track(add=list(records))
+        except ValueError as err:
+            self._error(
+                'Get from "memcached" store failed. JSON format error: {0}'.format(err))
+            pass
+        except:
+            self._error(
+                'Get from "memcached" store failed. Unknown error. Made reconnect\nKeys:', keys)
+            self.check()
+            pass
+        return records
+
+    def set_multi(self, records):
+        try:
+            failed = self._mc.set_multi(dict([(x, json.dumps(records[x], sort_keys=True)) for x in records]))
+            if failed:
+                self._error('Set to "memcached" store failed for keys:', failed)
+            self._track(add=[x for x in records if x not in failed])
+        except:
+            self._error(
+                'Set to "memcached" store failed. Unknown error. Made reconnect\nKeys:', list(records))
+            self.check()
+            pass
+
+    def delete_multi(self, keys):
+        try:
+            self._mc.delete_multi(keys)
+            self._track(remove=keys)
+        except:
+            self._error(
+                'Delete from "memcached" store failed. Unknown error. Made reconnect')
+            self.check()
+            pass
+
     def keys(self):
-        mkeys = {}
-        for server_item in self._mc.get_stats('items'):
-            for item in server_item[-1].keys():
-                keys_item = item.split(':')
-                if keys_item[2] == 'number':
-                    for server_dump in self._mc.get_stats(
-                            ' '.join(['cachedump', keys_item[1], server_item[-1][item]])):
-                        mkeys.update(server_dump[-1])
-        return mkeys.keys()
+        return sorted(set(self._read_manifest()[1]).union(self._manifest_add).difference(self._manifest_remove))
+
+    # Manifest changes of cycle are written once on commit
+    def begin(self):
+        self._batch = True
+
+    def commit(self):
+        self._batch = False
+        if not self._enabled or self._mc is None:
+            return
+        try:
+            add, remove = self._manifest_add, self._manifest_remove
+            if not self._seeded:
+                self._seeded = True
+                if self._read_manifest()[0] is None:
+                    add = add.union(self._dump_keys()).difference(remove)
+            if add or remove:
+                self._update_manifest(add, remove)
+        except:
+            self._error('Update manifest of "memcached" store failed. Unknown error. Made reconnect')
+            self.check()
+        self._manifest_add = set()
+        self._manifest_remove = set()
+
+    # Add keys to manifest and remove them, changes are kept until commit in transaction
+    def _track(self, add=(), remove=()):
+        if not self._batch:
+            self._update_manifest(add, remove)
+            return
+        self._manifest_add.update(add)
+        self._manifest_add.difference_update(remove)
+        self._manifest_remove.update(remove)
+        self._manifest_remove.difference_update(add)
+
+    # Keys of store records on servers, listed by slab cachedumps as before manifest
+    # Used once to seed manifest with records of older versions
+    def _dump_keys(self):
+        keys = set()
+        try:
+            for server_item in self._mc.get_stats('items'):
+                for item in server_item[-1].keys():
+                    keys_item = item.split(':')
+                    if keys_item[2] == 'number':
+                        for server_dump in self._mc.get_stats(
+                                ' '.join(['cachedump', keys_item[1], server_item[-1][item]])):
+                            keys.update(server_dump[-1])
+        except:
+            self._logger.warning('Keys of "memcached" store are not listed, records of older versions are not cleaned up')
+        # Store keys are sha1 of destinations and environments, other keys are not touched
+        return set([x for x in keys if len(x) == 40 and all([c in '0123456789abcdef' for c in x])])
+
+    def _manifest_key(self):
+        return self._config['memcached'].get('namespace', 'surok') + ':manifest'
+
+    # Read manifest of store keys
+    # Return tuple (raw manifest data or None, list of keys)
+    def _read_manifest(self):
+        data = self._mc.gets(self._manifest_key())
+        if data is None:
+            return None, []
+        try:
+            return data, json.loads(data)['keys']
+        except (ValueError, KeyError, TypeError) as err:
+            self._error(
+                'Manifest of "memcached" store is broken. Error: {0}'.format(err))
+            return data, []
+
+    # Add and remove keys of manifest with compare-and-swap, retry if manifest
+    # is changed by other client
+    def _update_manifest(self, add=(), remove=()):
+        for i in range(self._cas_retries):
+            data, keys = self._read_manifest()
+            new_keys = set(keys).union(add).difference(remove)
+            if data is not None and new_keys == set(keys):
+                return True
+            version = 0
+            if data is not None:
+                try:
+                    version = json.loads(data).get('version', 0)
+                except (ValueError, AttributeError):
+                    pass
+            manifest = json.dumps({'version': version + 1, 'keys': sorted(new_keys)})
+            if data is None:
+                stored = self._mc.add(self._manifest_key(), manifest)
+            else:
+                stored = self._mc.cas(self._manifest_key(), manifest)
+            if stored:
+                return True
+        self._error('Update manifest of "memcached" store failed. Too many concurrent updates.')
+        return False
 
     def delete(self, key):
         try:
             self._mc.delete(key)
+            self._track(remove=[key])
         except:
-            self._logger.error(
+            self._error(
                 'Delete from "memcached" store failed. Unknown error. Made reconnect')
             self.check()
             pass
+
+
+class StoreSqlite(_StoreTemplate):
+    """ Records are kept in SQLite database in WAL mode
+    ==================================================
+    Changes of cycle are committed in one transaction, changes out of
+    cycle are committed immediately.
+    """
+    _name = 'sqlite'
+    _enabled = False
+    _conn = None
+    _path = None
+    _transaction = False
+    _chunk_size = 500
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.check()
+
+    def _connect(self):
+        self._disconnect()
+        try:
+            self._conn = sqlite3.connect(self._path)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS records (hashid TEXT PRIMARY KEY, record TEXT NOT NULL)')
+            self._conn.commit()
+        except sqlite3.Error as err:
+            self._error(
+                'Open "sqlite" store {0} failed. Error: {1}'.format(self._path, err))
+            self._disconnect()
+
+    def _disconnect(self):
+        if self._conn is not None:
+            try:
+                self._conn.commit()
+                self._conn.close()
+            except sqlite3.Error:
+                pass
+        self._conn = None
+        self._transaction = False
+
+    def check(self):
+        conf = self._config['sqlite']
+        if conf['enabled']:
+            if self._conn is None or self._path != conf['path']:
+                self._path = conf['path']
+                self._connect()
+        else:
+            self._disconnect()
+        self._enabled = self._conn is not None
+
+    def begin(self):
+        self._transaction = True
+
+    def commit(self):
+        self._transaction = False
+        if self._conn is not None:
+            try:
+                self._conn.commit()
+            except sqlite3.Error as err:
+                self._error('Commit to "sqlite" store failed. Error: {0}'.format(err))
+
+    def _query(self, sql, params=()):
+        try:
+            return self._conn.execute(sql, params).fetchall()
+        except sqlite3.Error as err:
+            self._error('Get from "sqlite" store failed. Error: {0}'.format(err))
+        return []
+
+    # Changes are committed immediately, if transaction of cycle is not started
+    def _update(self, sql, rows):
+        try:
+            self._conn.executemany(sql, rows)
+            if not self._transaction:
+                self._conn.commit()
+        except sqlite3.Error as err:
+            self._error('Update of "sqlite" store failed. Error: {0}'.format(err))
+
+    def get(self, key, default=None):
+        return self.get_multi([key]).get(key, default)
+
+    def get_multi(self, keys):
+        records = {}
+        keys = list(keys)
+        for i in range(0, len(keys), self._chunk_size):
+            chunk = keys[i:i + self._chunk_size]
+            for hashid, record in self._query('SELECT hashid, record FROM records WHERE hashid IN ({})'.format(
+                    ','.join(['?'] * len(chunk))), chunk):
+                try:
+                    records[hashid] = json.loads(record)
+                except ValueError as err:
+                    self._error(
+                        'Get from "sqlite" store failed. JSON format error: {0}'.format(err))
+        return records
+
+    def set(self, key, value):
+        self.set_multi({key: value})
+
+    def set_multi(self, records):
+        self._update('INSERT OR REPLACE INTO records (hashid, record) VALUES (?, ?)',
+                     [(x, json.dumps(records[x], sort_keys=True)) for x in records])
+
+    def keys(self):
+        return [x[0] for x in self._query('SELECT hashid FROM records')]
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        self._update('DELETE FROM records WHERE hashid = ?', [(x,) for x in keys])
@@ -0,0 +1,70 @@
+import hashlib
+import threading
+import jinja2
+from .config import Config
+
+__all__ = ['Templates']
+
+
+class _SourceLoader(jinja2.BaseLoader):
+
+    def __init__(self):
+        self.sources = {}
+
+    def get_source(self, environment, template):
+        if template not in self.sources:
+            raise jinja2.TemplateNotFound(template)
+        return self.sources[template], None, lambda: True
+
+
+class Templates:
+    """ Public Templates object
+    ==================================================
+    Shared Jinja2 environment with cache of compiled templates.
+    Templates are cached by source hash, least recently used templates
+    are evicted when cache holds more than "cache_size" templates.
+    If "cache_dir" is set, compiled bytecode is stored in it and reused
+    after restart.
+    .get(source) - get compiled jinja2.Template for source
+    .render(source, **kwargs) - render source with kwargs
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(Templates, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, '_lock'):
+            self._config = Config()
+            self._lock = threading.Lock()
+            self._env = None
+            self._env_params = None
+
+    def _environment(self):
+        conf = self._config['templates']
+        params = (conf['cache_size'], conf.get('cache_dir'))
+        if self._env is None or self._env_params != params:
+            bytecode_cache = None
+            if params[1]:
+                bytecode_cache = jinja2.FileSystemBytecodeCache(params[1])
+            self._env = jinja2.Environment(loader=_SourceLoader(),
+                                           cache_size=params[0],
+                                           auto_reload=False,
+                                           bytecode_cache=bytecode_cache)
+            self._env_params = params
+        return self._env
+
+    def get(self, source):
+        name = hashlib.sha1(source.encode()).hexdigest()
+        with self._lock:
+            env = self._environment()
+            env.loader.sources[name] = source
+            try:
+                return env.get_template(name)
+            finally:
+                del env.loader.sources[name]
+
+    def render(self, source, **kwargs):
+        return self.get(source).render(**kwargs)
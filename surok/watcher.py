@@ -0,0 +1,197 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+from .config import Config
+from .logger import Logger
+from .discovery import Discovery
+
+__all__ = ['Watcher']
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+
+class _Inotify:
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    # Return list of (wd, mask, name) events
+    def read(self, timeout):
+        events = []
+        if select.select([self.fd], [], [], timeout)[0]:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            pos = 0
+            while pos + 16 <= len(data):
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, pos)
+                name = data[pos + 16:pos + 16 + length].rstrip(b'\0')
+                events.append((wd, mask, os.fsdecode(name)))
+                pos += 16 + length
+        return events
+
+
+class Watcher:
+    """ Public Watcher object
+    ==================================================
+    Watch changes of files and directories with inotify, or with polling
+    if inotify is not available. Every change wakes up main loop.
+    .watch(paths) - set list of watched directories and files
+    .changes() - get set of paths changed since previous call
+    """
+    _instance = None
+    _mask = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+             IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+    _poll_interval = 1
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(Watcher, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, '_lock'):
+            self._config = Config()
+            self._logger = Logger()
+            self._lock = threading.Lock()
+            self._dirs = {}
+            self._files = set()
+            self._wds = {}
+            self._changes = set()
+            self._stats = {}
+            self._thread = None
+            try:
+                self._inotify = _Inotify()
+            except (OSError, AttributeError) as err:
+                self._logger.warning('inotify is not available, use polling. Error: {}'.format(err))
+                self._inotify = None
+
+    def enabled(self):
+        return self._config.get('watch', True)
+
+    def watch(self, paths):
+        if not self.enabled():
+            return
+        # Directories are watched fully, files are watched over parent directory
+        dirs = {}
+        files = set()
+        for path in [os.path.abspath(x) for x in paths]:
+            if os.path.isdir(path):
+                dirs[path] = True
+            else:
+                dirs.setdefault(os.path.dirname(path), False)
+                files.add(path)
+        with self._lock:
+            if self._inotify is not None:
+                for path in [x for x in self._wds.values() if x not in dirs]:
+                    self._inotify.rm_watch([x for x in self._wds if self._wds[x] == path][0])
+                    self._wds = dict([x for x in self._wds.items() if x[1] != path])
+                for path in [x for x in dirs if x not in self._wds.values()]:
+                    try:
+                        self._wds[self._inotify.add_watch(path, self._mask)] = path
+                    except OSError as err:
+                        self._logger.warning('Watch directory {0} failed: {1}'.format(path, err))
+            self._dirs = dirs
+            self._files = files
+        if self._inotify is None:
+            # Start polling of new paths from current state
+            stats = self._poll_stats()
+            self._stats = dict([(x, self._stats.get(x, stats[x])) for x in stats])
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='surok-watcher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def changes(self):
+        with self._lock:
+            changes = self._changes
+            self._changes = set()
+        return changes
+
+    def _is_watched(self, path):
+        return self._dirs.get(os.path.dirname(path)) or path in self._files
+
+    def _run(self):
+        while self.enabled():
+            if self._inotify is not None:
+                changes = self._read_inotify()
+            else:
+                time.sleep(self._poll_interval)
+                changes = self._read_poll()
+            if changes:
+                self._logger.debug('Watched paths changed: ', sorted(changes))
+                with self._lock:
+                    self._changes.update(changes)
+                Discovery().notify(data=False)
+
+    def _read_inotify(self):
+        changes = set()
+        events = self._inotify.read(self._poll_interval)
+        with self._lock:
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    changes.update(self._files)
+                    changes.update([x for x in self._dirs if self._dirs[x]])
+                    continue
+                path = self._wds.get(wd)
+                if path is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self._wds[wd]
+                    continue
+                path = os.path.join(path, name) if name else path
+                if self._is_watched(path) or path in self._dirs:
+                    changes.add(path)
+        return changes
+
+    # Return dict of path: (mtime, size, inode) for watched files and directories entries
+    def _poll_stats(self):
+        stats = {}
+        with self._lock:
+            dirs = self._dirs.copy()
+            files = self._files.copy()
+        for path in files.union([os.path.join(x, y) for x in dirs if dirs[x] for y in self._listdir(x)]):
+            try:
+                st = os.stat(path)
+                stats[path] = (st.st_mtime_ns, st.st_size, st.st_ino)
+            except OSError:
+                pass
+        return stats
+
+    def _listdir(self, path):
+        try:
+            return os.listdir(path)
+        except OSError:
+            return []
+
+    def _read_poll(self):
+        stats = self._poll_stats()
+        changes = set([x for x in set(stats).union(self._stats) if stats.get(x) != self._stats.get(x)])
+        self._stats = stats
+        return changes
@@ -0,0 +1,134 @@
+import os
+import tempfile
+import threading
+from .config import Config
+from .logger import Logger
+from .metrics import Metrics
+from .store import new_hash
+
+__all__ = ['Writer']
+
+
+class Writer:
+    """ Public Writer object
+    ==================================================
+    Atomic writer of generated config files. Data is written to temporary
+    file in destination directory, synced and renamed over destination file
+    with owner and mode of replaced file. File is not written if its content
+    is not changed. If "batch_fsync" is true, directories are synced once
+    per cycle by .sync().
+    .write(dest, data, digest=None) - write data to dest, return True if file is changed
+        digest - content hash of data, if it is already computed
+    .sync() - sync directories of files written since previous call
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(Writer, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, '_lock'):
+            self._config = Config()
+            self._logger = Logger()
+            self._lock = threading.Lock()
+            self._hashes = {}
+            self._dirs = set()
+            self._umask = os.umask(0)
+            os.umask(self._umask)
+
+    def write(self, dest, data, digest=None):
+        path = os.path.realpath(dest)
+        data = data.encode()
+        if digest is None:
+            digest = new_hash(data).hexdigest()
+        st = self._stat(path)
+        if st is not None and self._hash(path, st) == digest:
+            return False
+        dirname = os.path.dirname(path)
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.',
+                                       suffix='.tmp', dir=dirname)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            if st is None:
+                os.chmod(tmp, 0o666 & ~self._umask)
+            else:
+                os.chmod(tmp, st.st_mode & 0o7777)
+                if (st.st_uid, st.st_gid) != (os.getuid(), os.getgid()):
+                    try:
+                        os.chown(tmp, st.st_uid, st.st_gid)
+                    except OSError as err:
+                        self._logger.warning(
+                            'Keep owner of config file {0} failed. OS error : {1}'.format(dest, err))
+            os.replace(tmp, path)
+            tmp = None
+        except OSError as err:
+            Metrics().inc('surok_failures_total', {'backend': 'write'})
+            self._logger.error(
+                'Config file {0} open or write error. OS error : {1}'.format(dest, err))
+            return False
+        finally:
+            if tmp is not None:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+        st = self._stat(path)
+        with self._lock:
+            if st is not None:
+                self._hashes[path] = (self._stat_key(st), self._hash_name(), digest)
+            if self._config.get('batch_fsync', False):
+                self._dirs.add(dirname)
+                return True
+        self._fsync_dir(dirname)
+        return True
+
+    def sync(self):
+        with self._lock:
+            dirs = self._dirs
+            self._dirs = set()
+        for dirname in sorted(dirs):
+            self._fsync_dir(dirname)
+
+    def _stat(self, path):
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+
+    def _stat_key(self, st):
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _hash_name(self):
+        return self._config.get('hash_algorithm', 'sha1')
+
+    # Hash of file content, cached while file and hash algorithm are not changed
+    def _hash(self, path, st):
+        key = (self._stat_key(st), self._hash_name())
+        with self._lock:
+            cached = self._hashes.get(path)
+        if cached is not None and cached[:2] == key:
+            return cached[2]
+        try:
+            with open(path, 'rb') as f:
+                digest = new_hash(f.read()).hexdigest()
+        except OSError:
+            return None
+        with self._lock:
+            self._hashes[path] = key + (digest,)
+        return digest
+
+    def _fsync_dir(self, dirname):
+        try:
+            fd = os.open(dirname, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError as err:
+            self._logger.warning('Sync directory {0} failed. OS error : {1}'.format(dirname, err))
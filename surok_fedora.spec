@@ -25,9 +25,14 @@ install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/apps.py %{buildroo
 install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/config.py %{buildroot}/opt/surok/surok
 install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/discovery.py %{buildroot}/opt/surok/surok
 install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/logger.py %{buildroot}/opt/surok/surok
+install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/metrics.py %{buildroot}/opt/surok/surok
+install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/profiler.py %{buildroot}/opt/surok/surok
+install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/reloader.py %{buildroot}/opt/surok/surok
 install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/store.py %{buildroot}/opt/surok/surok
 install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/system.py %{buildroot}/opt/surok/surok
 install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/templates.py %{buildroot}/opt/surok/surok
+install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/watcher.py %{buildroot}/opt/surok/surok
+install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok/writer.py %{buildroot}/opt/surok/surok
 install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/surok.py %{buildroot}/opt/surok
 mkdir -p %{buildroot}/etc/surok/{conf,conf.d,templates}
 install -p -m 644 /root/rpmbuild/BUILD/surok-%{version}/conf/surok.json %{buildroot}/etc/surok/conf
@@ -51,9 +56,14 @@ rm -rf $RPM_BUILD_ROOT
 /opt/surok/surok/config.py
 /opt/surok/surok/discovery.py
 /opt/surok/surok/logger.py
+/opt/surok/surok/metrics.py
+/opt/surok/surok/profiler.py
+/opt/surok/surok/reloader.py
 /opt/surok/surok/store.py
 /opt/surok/surok/system.py
 /opt/surok/surok/templates.py
+/opt/surok/surok/watcher.py
+/opt/surok/surok/writer.py
 /usr/share/surok/conf/surok_07.json
 /usr/share/surok/conf/surok_08.json
 /usr/share/surok/conf/surok_check.json